@@ -0,0 +1,215 @@
+"""
+Local stub of the OpenAI chat completions API for benchmarks.
+
+Answers POST /v1/chat/completions with a synthetic SOP analysis after a
+configurable latency, failing a configurable fraction of requests with
+429 or 500 responses. Streaming requests are answered with server-sent
+events, and batched requests (the "sop_analysis_batch" schema) with one
+analysis per image. Every response reports token usage.
+
+Usage:
+    python benchmarks/fake_openai_server.py --port 8765 --latency 2.0 --failure-rate 0.05
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=stub python sop_cli.py ...
+"""
+import json
+import time
+import random
+import argparse
+import threading
+import http.server
+
+
+def make_analysis(step_count, title="Synthetic Process"):
+    """
+    Build an analysis JSON with the given number of steps.
+    """
+    return {
+        "title": title,
+        "Objective": "Describe the synthetic process for benchmarking.",
+        "purpose": "Exercise parsing and rendering with realistic output sizes.",
+        "steps": [
+            {
+                "step": str(i + 1),
+                "role": f"Role {i % 4 + 1}",
+                "activities": [
+                    {
+                        "task": f"Task {i + 1}.{j + 1}",
+                        "details": [f"Detail {k + 1} of task {i + 1}.{j + 1}" for k in range(3)]
+                    }
+                    for j in range(2)
+                ]
+            }
+            for i in range(step_count)
+        ]
+    }
+
+
+class FakeOpenAIServer(http.server.ThreadingHTTPServer):
+    """
+    Threaded HTTP server holding the stub's settings and request counters.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, latency=1.0, jitter=0.0, failure_rate=0.0, step_count=8, seed=0):
+        super().__init__(address, FakeOpenAIHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.step_count = step_count
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "failures": 0, "streamed": 0}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def next_outcome(self):
+        """
+        Return (delay_seconds, failure_status or None) for the next request.
+        """
+        with self.lock:
+            self.counters["requests"] += 1
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            if self.random.random() < self.failure_rate:
+                self.counters["failures"] += 1
+                return delay, self.random.choice((429, 500))
+            return delay, None
+
+
+class FakeOpenAIHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+            return
+
+        delay, failure = self.server.next_outcome()
+        if failure:
+            time.sleep(min(delay, 0.05))
+            self._send_json(
+                failure,
+                {"error": {"message": "simulated failure", "type": "rate_limit" if failure == 429 else "server_error"}},
+                {"retry-after-ms": "100"} if failure == 429 else None
+            )
+            return
+
+        content = self._completion_content(request)
+        prompt_tokens = len(json.dumps(request.get("messages", []))) // 4
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": prompt_tokens + len(content) // 4,
+        }
+        if request.get("stream"):
+            self._stream(request, content, usage, delay)
+        else:
+            time.sleep(delay)
+            self._send_json(200, {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "stub"),
+                "choices": [{
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": content}
+                }],
+                "usage": usage,
+            })
+
+    def _completion_content(self, request):
+        schema = ((request.get("response_format") or {}).get("json_schema") or {}).get("name")
+        analysis = make_analysis(self.server.step_count)
+        if schema == "sop_analysis_batch":
+            images = sum(
+                part.get("type") == "image_url"
+                for message in request.get("messages", [])
+                if isinstance(message.get("content"), list)
+                for part in message["content"]
+            )
+            # Counting the reference image too only adds a surplus diagram, which is ignored
+            return json.dumps({"diagrams": [analysis] * max(1, images)})
+        return json.dumps(analysis)
+
+    def _stream(self, request, content, usage, delay):
+        with self.server.lock:
+            self.server.counters["streamed"] += 1
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        chunk_size = max(1, len(content) // 20)
+        pieces = [content[i:i + chunk_size] for i in range(0, len(content), chunk_size)]
+        chunks = [{"index": 0, "delta": {"role": "assistant", "content": piece}, "finish_reason": None} for piece in pieces]
+        for choice in chunks:
+            time.sleep(delay / len(chunks))
+            self._send_event({"choices": [choice]}, request)
+        self._send_event({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}, request)
+        if (request.get("stream_options") or {}).get("include_usage"):
+            self._send_event({"choices": [], "usage": usage}, request)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _send_event(self, body, request):
+        body = dict(body, id="chatcmpl-stub", object="chat.completion.chunk",
+                    created=int(time.time()), model=request.get("model", "stub"))
+        self.wfile.write(f"data: {json.dumps(body)}\n\n".encode('utf-8'))
+        self.wfile.flush()
+
+
+def start_server(host="127.0.0.1", port=0, **settings):
+    """
+    Start the stub in a background thread and return the server.
+    """
+    server = FakeOpenAIServer((host, port), **settings)
+    threading.Thread(target=server.serve_forever, daemon=True, name="fake-openai").start()
+    return server
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=1.0, help="seconds per completion")
+    parser.add_argument("--jitter", type=float, default=0.0, help="+/- seconds of uniform latency jitter")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of requests answered with 429/500")
+    parser.add_argument("--steps", type=int, default=8, help="steps in each synthetic analysis")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(
+        (args.host, args.port),
+        latency=args.latency,
+        jitter=args.jitter,
+        failure_rate=args.failure_rate,
+        step_count=args.steps,
+        seed=args.seed
+    )
+    print(f"Serving fake OpenAI API at {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main_cli()
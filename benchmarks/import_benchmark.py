@@ -0,0 +1,63 @@
+"""
+Benchmark cold import time of the app modules in fresh interpreters.
+
+Each case runs in a new Python process, so nothing is cached in
+sys.modules. "eager deps" imports the pipeline together with PyMuPDF,
+PIL, python-docx and openai, which is what importing it used to cost
+before those imports were deferred to first use.
+
+Usage:
+    python benchmarks/import_benchmark.py --runs 10
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = (
+    ("interpreter", "pass"),
+    ("sop_pipeline", "import sop_pipeline"),
+    ("sop_cli", "import sop_cli"),
+    ("main (UI)", "import main"),
+    ("eager deps", "import sop_pipeline, fitz, PIL.Image, docx, openai"),
+    ("first client", "import sop_pipeline; sop_pipeline.get_client()"),
+)
+
+
+def time_statement(statement, runs):
+    env = dict(os.environ, OPENAI_API_KEY=os.getenv("OPENAI_API_KEY", "benchmark"))
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", statement], cwd=ROOT, env=env, capture_output=True, text=True)
+        timings.append(time.perf_counter() - start)
+        if result.returncode:
+            raise RuntimeError(f"{statement!r} failed:\n{result.stderr}")
+    return timings
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    # Warm the OS file cache and bytecode so the first case is not penalised
+    for _, statement in CASES:
+        time_statement(statement, 1)
+
+    print(f"Cold import, {args.runs} runs (wall time of a fresh interpreter)")
+    print(f"{'case':<16}{'mean ms':>10}{'median ms':>12}{'min ms':>10}")
+    for label, statement in CASES:
+        timings = time_statement(statement, args.runs)
+        print(
+            f"{label:<16}{statistics.mean(timings) * 1000:>10.1f}"
+            f"{statistics.median(timings) * 1000:>12.1f}{min(timings) * 1000:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,271 @@
+"""
+End-to-end pipeline benchmark against a local fake OpenAI API.
+
+Generates synthetic flowchart PDFs of varying page count, image count and
+image size (deterministic for a given --seed), starts the stub server from
+fake_openai_server.py in this process and runs them through
+process_single_pdf (one at a time) and/or process_zip_file (concurrently).
+Reports documents per minute, p50/p95 document latency, peak RSS and a
+per-stage breakdown from sop_metrics. Latency is the wall time of each
+call in single mode and, in zip mode, the time each document spent in
+extraction, analysis and rendering (excluding queueing for a worker). The analysis cache and the
+shared result store are disabled unless --cache is given, so every document reaches the stub.
+
+Usage:
+    python benchmarks/pipeline_benchmark.py --docs 20 --latency 1.0 --failure-rate 0.05
+    python benchmarks/pipeline_benchmark.py --mode zip --concurrency 8 --json bench.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import zipfile
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageDraw
+
+import sop_metrics
+import sop_pipeline
+from sop_store import ResultStore
+from fake_openai_server import start_server
+
+
+def make_flowchart(rng, width, height, box_count):
+    """
+    Draw a left-to-right flowchart of labelled boxes joined by arrows.
+    """
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    columns = min(box_count, 5)
+    rows = (box_count + columns - 1) // columns
+    box_width = width // (columns * 2)
+    box_height = height // (rows * 3)
+    for index in range(box_count):
+        row, column = divmod(index, columns)
+        left = box_width // 2 + column * box_width * 2
+        top = box_height + row * box_height * 3
+        draw.rectangle([left, top, left + box_width, top + box_height], outline="black", width=3)
+        draw.text((left + 8, top + 8), f"Step {index + 1} {rng.randint(100, 999)}", fill="black")
+        if column < columns - 1 and index < box_count - 1:
+            middle = top + box_height // 2
+            draw.line([left + box_width, middle, left + box_width * 2, middle], fill="black", width=3)
+            draw.polygon(
+                [(left + box_width * 2, middle), (left + box_width * 2 - 10, middle - 6), (left + box_width * 2 - 10, middle + 6)],
+                fill="black"
+            )
+    return image
+
+
+def make_pdf(rng, page_count, image_count, min_size, max_size):
+    """
+    Build a PDF with image_count flowcharts spread over page_count pages,
+    plus a small logo on every page that extraction should ignore.
+    """
+    document = fitz.open()
+    logo = io.BytesIO()
+    Image.new("RGB", (60, 40), (200, 30, 30)).save(logo, "PNG")
+    for page_index in range(page_count):
+        page = document.new_page()
+        page.insert_image(fitz.Rect(20, 15, 80, 55), stream=logo.getvalue())
+        page.insert_text((100, 40), f"Synthetic document page {page_index + 1}")
+    for image_index in range(image_count):
+        width = rng.randint(min_size, max_size)
+        height = int(width * rng.uniform(0.5, 0.8))
+        flowchart = make_flowchart(rng, width, height, rng.randint(4, 12))
+        stream = io.BytesIO()
+        flowchart.save(stream, "PNG")
+        page = document[image_index % page_count]
+        page.insert_image(fitz.Rect(50, 120, 550, 120 + 500 * height / width), stream=stream.getvalue())
+    return document.tobytes(garbage=3, deflate=True)
+
+
+def make_corpus(count, seed, max_pages, max_images, min_size, max_size):
+    rng = random.Random(seed)
+    corpus = []
+    for index in range(count):
+        page_count = rng.randint(1, max_pages)
+        image_count = rng.randint(1, max_images)
+        corpus.append((f"synthetic_{index:03d}.pdf", make_pdf(rng, page_count, image_count, min_size, max_size)))
+    return corpus
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process and of its (pool worker) children.
+    """
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale,
+    )
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run_single(corpus, reference_set):
+    latencies = []
+    succeeded = 0
+    for _, pdf_data in corpus:
+        start = time.perf_counter()
+        result = sop_pipeline.process_single_pdf(pdf_data, reference_set=reference_set)
+        latencies.append(time.perf_counter() - start)
+        succeeded += result is not None
+    return latencies, succeeded
+
+
+def run_zip(corpus, concurrency, reference_set):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zipf:
+        for name, pdf_data in corpus:
+            zipf.writestr(name, pdf_data)
+
+    # Per-document latency and status come from the metrics events
+    with tempfile.TemporaryDirectory() as temp_dir:
+        events_path = os.path.join(temp_dir, "events.jsonl")
+        previous_log, sop_metrics.METRICS_LOG = sop_metrics.METRICS_LOG, events_path
+        try:
+            result = sop_pipeline.process_zip_file(archive.getvalue(), max_workers=concurrency, reference_set=reference_set)
+        finally:
+            sop_metrics.METRICS_LOG = previous_log
+
+        document_seconds = {}
+        succeeded = 0
+        with open(events_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                event = json.loads(line)
+                if event["event"] == "stage" and event.get("document"):
+                    document_seconds[event["document"]] = document_seconds.get(event["document"], 0.0) + event["seconds"]
+                elif event["event"] == "document" and event["status"] == "done":
+                    succeeded += 1
+
+    with zipfile.ZipFile(io.BytesIO(result)) as zipf:
+        print(f"Result archive: {len(zipf.namelist())} DOCX files, {len(result) / 1024:.0f} KB")
+    return list(document_seconds.values()), succeeded
+
+
+def run_mode(mode, corpus, args, server):
+    metrics_before = sop_metrics.snapshot()
+    requests_before = dict(server.counters)
+    start = time.perf_counter()
+    if mode == "single":
+        latencies, succeeded = run_single(corpus, args.reference_set)
+    else:
+        latencies, succeeded = run_zip(corpus, args.concurrency, args.reference_set)
+    elapsed = time.perf_counter() - start
+    rss_self, rss_children = peak_rss_mb()
+    return {
+        "mode": mode,
+        "documents": len(corpus),
+        "succeeded": succeeded,
+        "seconds": round(elapsed, 3),
+        "docs_per_minute": round(len(corpus) / elapsed * 60, 2),
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p95": percentile(latencies, 0.95),
+        "peak_rss_mb": rss_self,
+        "peak_rss_children_mb": rss_children,
+        "stub_requests": server.counters["requests"] - requests_before["requests"],
+        "stub_failures": server.counters["failures"] - requests_before["failures"],
+        "metrics": sop_metrics.diff(metrics_before, sop_metrics.snapshot()),
+    }
+
+
+def print_result(result):
+    def fmt(value, unit=""):
+        return "n/a" if value is None else f"{value:.2f}{unit}"
+
+    print(f"\n== {result['mode']}: {result['succeeded']}/{result['documents']} documents in {result['seconds']:.1f}s")
+    print(f"throughput      {result['docs_per_minute']:.1f} docs/min")
+    print(f"latency         p50 {fmt(result['latency_p50'], 's')}  p95 {fmt(result['latency_p95'], 's')}")
+    print(f"peak RSS        {fmt(result['peak_rss_mb'], ' MB')} (pool workers {fmt(result['peak_rss_children_mb'], ' MB')})")
+    print(f"stub requests   {result['stub_requests']} ({result['stub_failures']} simulated failures)")
+    print(f"{'stage':<16}{'count':>7}{'total s':>10}{'mean ms':>10}{'max ms':>10}")
+    for stage, timer in sorted(result["metrics"]["timers"].items()):
+        print(
+            f"{stage:<16}{timer['count']:>7}{timer['seconds']:>10.2f}"
+            f"{timer['seconds'] / timer['count'] * 1000:>10.1f}{timer['max'] * 1000:>10.1f}"
+        )
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("single", "zip", "both"), default="both")
+    parser.add_argument("--docs", type=int, default=20, help="number of synthetic PDFs")
+    parser.add_argument("--max-pages", type=int, default=4)
+    parser.add_argument("--max-images", type=int, default=3, help="maximum flowchart images per PDF")
+    parser.add_argument("--min-size", type=int, default=800, help="minimum flowchart width in pixels")
+    parser.add_argument("--max-size", type=int, default=3000, help="maximum flowchart width in pixels")
+    parser.add_argument("--concurrency", type=int, default=sop_pipeline.MAX_API_WORKERS, help="API workers in zip mode")
+    parser.add_argument("--latency", type=float, default=1.0, help="stub seconds per completion")
+    parser.add_argument("--jitter", type=float, default=0.2, help="stub +/- latency jitter in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of stub requests failing with 429/500")
+    parser.add_argument("--steps", type=int, default=8, help="steps in each stub analysis")
+    parser.add_argument("--rpm", type=int, default=0, help="client requests-per-minute budget (0: unlimited)")
+    parser.add_argument("--tpm", type=int, default=0, help="client tokens-per-minute budget (0: unlimited)")
+    parser.add_argument("--reference-set", default=None)
+    parser.add_argument("--cache", action="store_true", help="keep the analysis cache enabled")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", default=None, help="also write the results as JSON to this path")
+    args = parser.parse_args()
+
+    if not args.cache:
+        sop_pipeline.ANALYSIS_CACHE_DIR = ""
+        # Still deduplicates identical PDFs in flight, but keeps no results
+        sop_pipeline.set_result_store(ResultStore(max_bytes=0, db_path=""))
+    # Each run starts from scratch instead of resuming an earlier batch
+    sop_pipeline.BATCH_DIR = ""
+
+    server = start_server(
+        latency=args.latency,
+        jitter=args.jitter,
+        failure_rate=args.failure_rate,
+        step_count=args.steps,
+        seed=args.seed
+    )
+    from openai import OpenAI
+    sop_pipeline.set_client(sop_pipeline.RateLimitedClient(
+        OpenAI(api_key="benchmark", base_url=server.base_url, max_retries=0),
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm
+    ))
+
+    start = time.perf_counter()
+    corpus = make_corpus(args.docs, args.seed, args.max_pages, args.max_images, args.min_size, args.max_size)
+    total_mb = sum(len(pdf_data) for _, pdf_data in corpus) / 1024 / 1024
+    print(
+        f"Generated {len(corpus)} PDFs ({total_mb:.1f} MB) in {time.perf_counter() - start:.1f}s; "
+        f"stub latency {args.latency}s +/- {args.jitter}s, failure rate {args.failure_rate:.0%}, "
+        f"multi-flowchart mode {sop_pipeline.MULTI_FLOWCHART_MODE}"
+    )
+
+    results = []
+    for mode in (("single", "zip") if args.mode == "both" else (args.mode,)):
+        results.append(run_mode(mode, corpus, args, server))
+        print_result(results[-1])
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"arguments": vars(args), "results": results}, f, indent=2)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main_cli()
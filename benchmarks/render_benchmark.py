@@ -0,0 +1,85 @@
+"""
+Benchmark DOCX rendering with and without the cached document template.
+
+Usage:
+    python benchmarks/render_benchmark.py --steps 100 --runs 20
+"""
+import io
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw
+import sop_pipeline
+
+
+def make_analysis(step_count):
+    """
+    Build a synthetic analysis JSON with the given number of steps.
+    """
+    return {
+        "title": "Benchmark Process",
+        "Objective": "Objective text for the benchmark document.",
+        "purpose": "Purpose text for the benchmark document.",
+        "steps": [
+            {
+                "step": i + 1,
+                "role": f"Role {i % 5}",
+                "activities": [
+                    {
+                        "task": f"Task {i + 1}.{j + 1}",
+                        "details": [f"Detail {k + 1} of task {i + 1}.{j + 1}" for k in range(4)]
+                    }
+                    for j in range(2)
+                ]
+            }
+            for i in range(step_count)
+        ]
+    }
+
+
+def make_image():
+    image = Image.new("RGB", (1200, 800), "white")
+    draw = ImageDraw.Draw(image)
+    for i in range(5):
+        draw.rectangle([40 + i * 230, 350, 200 + i * 230, 450], outline="black", width=3)
+    return image
+
+
+def time_render(analysis, image, use_template, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        sop_pipeline.create_docx_from_analysis(analysis, io.BytesIO(), image, use_template=use_template)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    analysis = make_analysis(args.steps)
+    image = make_image()
+
+    # Warm up the template cache so it is not counted against the cached path
+    sop_pipeline.create_docx_from_analysis(analysis, io.BytesIO(), image)
+
+    print(f"DOCX render, {args.steps} steps, {args.runs} runs")
+    print(f"{'mode':<12}{'mean ms':>10}{'median ms':>12}{'min ms':>10}")
+    for label, use_template in (("rebuild", False), ("template", True)):
+        timings = time_render(analysis, image, use_template, args.runs)
+        print(
+            f"{label:<12}{statistics.mean(timings) * 1000:>10.1f}"
+            f"{statistics.median(timings) * 1000:>12.1f}{min(timings) * 1000:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,186 @@
+"""
+Headless batch SOP generation.
+
+Usage:
+    python sop_cli.py INPUT [INPUT ...] -o OUTPUT_DIR [--concurrency N]
+                      [--reference-set NAME] [--resume] [--manifest PATH]
+                      [--report PATH] [--metrics PATH]
+
+INPUT may be a PDF, a ZIP of PDFs, a directory (searched recursively for
+PDFs and ZIPs) or a glob pattern. Generated DOCX files are written to
+OUTPUT_DIR as they complete. A manifest recording each input's content
+hash, stage, status and outputs is kept in OUTPUT_DIR/manifest.json; with
+--resume, inputs already completed with the same content and settings are
+skipped and only new, changed, failed or flagged ones are processed.
+Inputs in which no image looks like a process flow diagram are flagged
+for review instead of being sent to the API, or with
+SOP_LOW_CONFIDENCE_POLICY=send analyzed with a warning. The report includes per-stage timings,
+token usage, image payload sizes and cache hits; --metrics also writes
+them in the Prometheus text format.
+
+The same functionality is available from Python through run_batch().
+Importing this module does not import streamlit or create an OpenAI client.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import zipfile
+import tempfile
+import threading
+
+import sop_metrics
+from sop_pipeline import MANIFEST_NAME, MAX_API_WORKERS, get_client_counters, iter_resumable_batch, iter_zip_pdfs
+
+
+def collect_inputs(patterns, spool_dir):
+    """
+    Expand input paths, directories and globs into (source_id, name, pdf_path).
+
+    ZIP archives contribute one entry per PDF member, identified as
+    "<zip path>!<member path>" and copied into spool_dir one at a time.
+    Entries are returned in a stable order; no PDF is read into memory.
+    """
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, _, files in os.walk(pattern):
+                for filename in files:
+                    if filename.lower().endswith(('.pdf', '.zip')):
+                        paths.add(os.path.join(root, filename))
+        elif glob.has_magic(pattern):
+            paths.update(glob.glob(pattern, recursive=True))
+        elif os.path.exists(pattern):
+            paths.add(pattern)
+        else:
+            print(f"Input not found: {pattern}", file=sys.stderr)
+
+    inputs = []
+    for index, path in enumerate(sorted(paths)):
+        if path.lower().endswith('.zip'):
+            member_dir = os.path.join(spool_dir, str(index))
+            os.makedirs(member_dir)
+            try:
+                for member_path, pdf_path in iter_zip_pdfs(path, spool_dir=member_dir, full_paths=True):
+                    inputs.append((f"{path}!{member_path}", os.path.basename(member_path), pdf_path))
+            except (ValueError, zipfile.BadZipFile) as e:
+                print(f"Skipping {path}: {e}", file=sys.stderr)
+        elif path.lower().endswith('.pdf'):
+            inputs.append((path, os.path.basename(path), path))
+    return inputs
+
+
+def run_batch(inputs, output_dir, concurrency=None, reference_set=None,
+              manifest_path=None, resume=False, report_path=None, metrics_path=None):
+    """
+    Generate SOP documents for the given inputs and return a summary dict.
+
+    inputs are paths, directories or globs (see collect_inputs). Outputs
+    are written to output_dir, the manifest is updated after every
+    document, and the summary is also written to report_path if given.
+    Metrics are written in the Prometheus text format to metrics_path
+    (default SOP_METRICS_FILE) if set.
+    """
+    started = time.time()
+    metrics_before = sop_metrics.snapshot()
+    counters_before = get_client_counters()
+    manifest_path = manifest_path or os.path.join(output_dir, MANIFEST_NAME)
+    
+    stage_started = {}
+    stage_lock = threading.Lock()
+    
+    def on_progress(index, stage, error=None):
+        if stage == "extracting":
+            with stage_lock:
+                stage_started[index] = time.time()
+    
+    report_documents = []
+    with tempfile.TemporaryDirectory() as spool_dir:
+        results = iter_resumable_batch(
+            collect_inputs(inputs, spool_dir),
+            output_dir,
+            manifest_path=manifest_path,
+            resume=resume,
+            max_workers=concurrency,
+            reference_set=reference_set,
+            progress=on_progress
+        )
+        for index, (source_id, entry, skipped) in enumerate(results):
+            if skipped:
+                report_documents.append(dict(entry, input=source_id, status="skipped"))
+                continue
+            with stage_lock:
+                seconds = round(time.time() - stage_started.get(index, started), 3)
+            report_documents.append(dict(entry, input=source_id, seconds=seconds))
+            error = entry["error"] or entry.get("note")
+            print(f"{entry['status']}: {source_id}" + (f" ({error})" if error else ""), file=sys.stderr)
+    
+    skipped = sum(doc["status"] == "skipped" for doc in report_documents)
+    # API counters are cumulative for the process, so report this run's share
+    counters = get_client_counters()
+    api = {name: value - counters_before.get(name, 0) for name, value in counters.items()}
+    summary = {
+        "started": started,
+        "finished": time.time(),
+        "duration_seconds": round(time.time() - started, 3),
+        "output_dir": output_dir,
+        "manifest": manifest_path,
+        "total": len(report_documents),
+        "succeeded": sum(doc["status"] == "done" for doc in report_documents),
+        "failed": sum(doc["status"] == "failed" for doc in report_documents),
+        "flagged": sum(doc["status"] == "flagged" for doc in report_documents),
+        "skipped": skipped,
+        "api": {name: value for name, value in api.items() if value},
+        "metrics": sop_metrics.diff(metrics_before, sop_metrics.snapshot()),
+        "documents": report_documents,
+    }
+    sop_metrics.write_prometheus_file(metrics_path)
+
+    if report_path:
+        if report_path == "-":
+            json.dump(summary, sys.stdout, indent=2)
+            print()
+        else:
+            with open(report_path, 'w', encoding='utf-8') as f:
+                json.dump(summary, f, indent=2)
+
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+", help="PDF/ZIP files, directories or glob patterns")
+    parser.add_argument("-o", "--output-dir", required=True, help="directory for generated DOCX files")
+    parser.add_argument("-c", "--concurrency", type=int, default=MAX_API_WORKERS, help="concurrent API requests")
+    parser.add_argument("--reference-set", default=None, help="reference set (SOP style) to use")
+    parser.add_argument("--resume", action="store_true", help="skip inputs completed in the manifest")
+    parser.add_argument("--manifest", default=None, help=f"manifest path (default: OUTPUT_DIR/{MANIFEST_NAME})")
+    parser.add_argument("--report", default=None, help="write a JSON summary report to this path ('-' for stdout)")
+    parser.add_argument("--metrics", default=None, help="write Prometheus text-format metrics to this path")
+    args = parser.parse_args(argv)
+
+    summary = run_batch(
+        args.inputs,
+        args.output_dir,
+        concurrency=args.concurrency,
+        reference_set=args.reference_set,
+        manifest_path=args.manifest,
+        resume=args.resume,
+        report_path=args.report,
+        metrics_path=args.metrics
+    )
+    for row in sop_metrics.summary_rows(summary["metrics"]):
+        if row["Count"] is not None and row["Mean"] is not None:
+            print(f"{row['Metric']:<24}{row['Count']:>6} x {row['Mean']:.3f}s (max {row['Max']:.3f}s)", file=sys.stderr)
+    print(
+        f"{summary['succeeded']} succeeded, {summary['failed']} failed, "
+        f"{summary['flagged']} flagged, {summary['skipped']} skipped in {summary['duration_seconds']:.1f}s",
+        file=sys.stderr
+    )
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,344 @@
+"""
+Background job store for SOP generation: SQLite status database plus
+input and output files under SOP_JOBS_DIR.
+"""
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import zipfile
+import threading
+from contextlib import closing
+
+import sop_metrics
+from sop_pipeline import claim_output_name, dump_analysis_json, iter_pdf_batch, load_analysis_json, render_from_analyses
+
+JOBS_DIR = os.getenv("SOP_JOBS_DIR", ".sop_jobs")
+MAX_CONCURRENT_JOBS = int(os.getenv("SOP_MAX_CONCURRENT_JOBS", "1"))
+JOB_FINISHED_STATUSES = ("done", "failed")
+# Files can also end "flagged" (no image passed the flowchart classifier)
+FILE_FINISHED_STATUSES = ("done", "failed", "flagged")
+JOBS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    finished REAL,
+    status TEXT NOT NULL,
+    reference_set TEXT,
+    max_workers INTEGER,
+    error TEXT,
+    metrics TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS job_files (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    timings TEXT NOT NULL DEFAULT '{}',
+    output_path TEXT,
+    preview TEXT NOT NULL DEFAULT '[]',
+    outputs TEXT NOT NULL DEFAULT '[]',
+    analyses TEXT NOT NULL DEFAULT '[]',
+    PRIMARY KEY (job_id, idx)
+);
+"""
+
+def _jobs_db():
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(JOBS_DIR, "jobs.db"), timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(JOBS_SCHEMA)
+    # Databases created by older versions lack the newer JSON columns
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(job_files)")}
+    for column in ("preview", "outputs", "analyses"):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE job_files ADD COLUMN {column} TEXT NOT NULL DEFAULT '[]'")
+    if "metrics" not in {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}:
+        conn.execute("ALTER TABLE jobs ADD COLUMN metrics TEXT NOT NULL DEFAULT '{}'")
+    return conn
+
+def _job_dir(job_id):
+    return os.path.join(JOBS_DIR, job_id)
+
+def job_result_path(job_id):
+    """
+    Path of the results zip for a job (exists once the job has finished).
+    """
+    return os.path.join(_job_dir(job_id), "results.zip")
+
+def _write_input(input_path, pdf_source):
+    if isinstance(pdf_source, (bytes, bytearray, memoryview)):
+        with open(input_path, "wb") as f:
+            f.write(pdf_source)
+    elif isinstance(pdf_source, (str, os.PathLike)):
+        shutil.copyfile(pdf_source, input_path)
+    else:
+        with open(input_path, "wb") as f:
+            shutil.copyfileobj(pdf_source, f, 1024 * 1024)
+
+def _analyses_path(job_id, index):
+    # Analyses supplied with the upload (or edited since) for an input PDF
+    return os.path.join(_job_dir(job_id), "inputs", f"{index}.json")
+
+def create_job(pdf_items, reference_set=None, max_workers=None):
+    """
+    Store the input PDFs of a new job on disk and register it as queued.
+    
+    pdf_items yields (name, pdf) pairs where pdf is bytes, a path or a
+    readable file object; they are written one at a time, so items can be
+    streamed straight from an upload or a ZIP archive. An item may also be
+    a (name, pdf, analyses) triple, in which case that PDF is rendered from
+    the given analyses without calling the model. Raises ValueError (and
+    stores nothing) if there are no PDFs or the input is rejected.
+    """
+    job_id = uuid.uuid4().hex[:12]
+    input_dir = os.path.join(_job_dir(job_id), "inputs")
+    os.makedirs(input_dir)
+    
+    file_rows = []
+    try:
+        for index, (name, pdf_source, *analyses) in enumerate(pdf_items):
+            _write_input(os.path.join(input_dir, f"{index}.pdf"), pdf_source)
+            if analyses and analyses[0]:
+                with open(_analyses_path(job_id, index), "w", encoding="utf-8") as f:
+                    f.write(dump_analysis_json(analyses[0]))
+            file_rows.append((job_id, index, name, "queued"))
+        if not file_rows:
+            raise ValueError("No PDF files found in the upload")
+    except Exception:
+        shutil.rmtree(_job_dir(job_id), ignore_errors=True)
+        raise
+    
+    with closing(_jobs_db()) as conn, conn:
+        conn.execute(
+            "INSERT INTO jobs (id, created, status, reference_set, max_workers) VALUES (?, ?, ?, ?, ?)",
+            (job_id, time.time(), "queued", reference_set, max_workers)
+        )
+        conn.executemany("INSERT INTO job_files (job_id, idx, name, status) VALUES (?, ?, ?, ?)", file_rows)
+    return job_id
+
+def get_job(job_id):
+    """
+    Return a job and its files as a dict, or None if the job does not exist.
+    """
+    with closing(_jobs_db()) as conn:
+        job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if job is None:
+            return None
+        files = conn.execute("SELECT * FROM job_files WHERE job_id = ? ORDER BY idx", (job_id,)).fetchall()
+    
+    job = dict(job, metrics=json.loads(job["metrics"]))
+    job["files"] = [
+        dict(
+            row,
+            timings=json.loads(row["timings"]),
+            preview=json.loads(row["preview"]),
+            outputs=json.loads(row["outputs"]),
+            analyses=json.loads(row["analyses"])
+        )
+        for row in files
+    ]
+    return job
+
+def list_unfinished_jobs():
+    with closing(_jobs_db()) as conn:
+        rows = conn.execute(
+            "SELECT id FROM jobs WHERE status NOT IN (?, ?) ORDER BY created",
+            JOB_FINISHED_STATUSES
+        ).fetchall()
+    return [row["id"] for row in rows]
+
+def _update_job(job_id, **fields):
+    assignments = ", ".join(f"{column} = ?" for column in fields)
+    with closing(_jobs_db()) as conn, conn:
+        conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+def _update_job_file(job_id, index, **fields):
+    assignments = ", ".join(f"{column} = ?" for column in fields)
+    with closing(_jobs_db()) as conn, conn:
+        conn.execute(
+            f"UPDATE job_files SET {assignments} WHERE job_id = ? AND idx = ?",
+            (*fields.values(), job_id, index)
+        )
+
+def _load_input_analyses(job_id, index):
+    try:
+        with open(_analyses_path(job_id, index), "r", encoding="utf-8") as f:
+            return load_analysis_json(f.read())
+    except FileNotFoundError:
+        return None
+
+def _write_results_zip(job_id, files):
+    result_path = job_result_path(job_id)
+    with zipfile.ZipFile(f"{result_path}.part", 'w') as zipf:
+        for job_file in files:
+            for output_name, output_path in job_file["outputs"]:
+                zipf.write(output_path, output_name)
+    os.replace(f"{result_path}.part", result_path)
+
+def _job_metrics(metrics_before):
+    return json.dumps(sop_metrics.diff(metrics_before, sop_metrics.snapshot()))
+
+def run_job(job_id):
+    """
+    Process all files of a stored job, recording per-file stage and timings.
+    """
+    job = get_job(job_id)
+    if job is None:
+        return
+    
+    job_dir = _job_dir(job_id)
+    output_dir = os.path.join(job_dir, "outputs")
+    os.makedirs(output_dir, exist_ok=True)
+    
+    stage_started = {}
+    timings = {}
+    timings_lock = threading.Lock()
+    
+    def on_progress(index, stage, error=None):
+        now = time.time()
+        with timings_lock:
+            previous = stage_started.get(index)
+            file_timings = timings.setdefault(index, {})
+            if previous:
+                file_timings[previous[0]] = round(now - previous[1], 3)
+            stage_started[index] = (stage, now)
+            timings_json = json.dumps(file_timings)
+        _update_job_file(job_id, index, status=stage, error=error, timings=timings_json)
+    
+    previews = {}
+    
+    def on_analyses(index, analyses):
+        _update_job_file(job_id, index, analyses=json.dumps(analyses))
+    
+    def on_step(index, step):
+        with timings_lock:
+            steps = previews.setdefault(index, [])
+            steps.append(step)
+            preview_json = json.dumps(steps)
+        _update_job_file(job_id, index, preview=preview_json)
+    
+    # Metrics recorded while this job runs; other jobs running at the same
+    # time (SOP_MAX_CONCURRENT_JOBS > 1) are included in the difference
+    metrics_before = sop_metrics.snapshot()
+    try:
+        _update_job(job_id, status="running")
+        # Files finished before an interruption (e.g. a server restart) keep
+        # their outputs; only the rest are processed again
+        finished_outputs = {
+            job_file["idx"]: job_file["outputs"]
+            for job_file in job["files"]
+            if job_file["status"] == "done"
+            and job_file["outputs"]
+            and all(os.path.exists(path) for _, path in job_file["outputs"])
+        }
+        # Inputs are passed by path, so the PDFs are not held in memory
+        pending = [
+            (
+                job_file["idx"],
+                job_file["name"],
+                os.path.join(job_dir, "inputs", f"{job_file['idx']}.pdf"),
+                _load_input_analyses(job_id, job_file["idx"])
+            )
+            for job_file in job["files"]
+            if job_file["idx"] not in finished_outputs
+        ]
+        
+        result_path = job_result_path(job_id)
+        with zipfile.ZipFile(f"{result_path}.part", 'w') as zipf:
+            results = iter_pdf_batch(
+                [(name, pdf_path, analyses) for _, name, pdf_path, analyses in pending],
+                max_workers=job["max_workers"],
+                reference_set=job["reference_set"],
+                progress=lambda pending_index, *args: on_progress(pending[pending_index][0], *args),
+                step_progress=lambda pending_index, step: on_step(pending[pending_index][0], step),
+                analyses_progress=lambda pending_index, analyses: on_analyses(pending[pending_index][0], analyses)
+            )
+            # Files with the same name (e.g. x.pdf from two ZIP folders) get
+            # numbered output names, so the archive has no duplicate entries
+            claimed_names = {
+                output_name for outputs in finished_outputs.values() for output_name, _ in outputs
+            }
+            for job_file in job["files"]:
+                index = job_file["idx"]
+                if index in finished_outputs:
+                    for output_name, output_path in finished_outputs[index]:
+                        zipf.write(output_path, output_name)
+                    continue
+                
+                filename, outputs, error = next(results)
+                if error:
+                    print(f"Error processing {filename}: {error}")
+                    continue
+                output_records = []
+                for output_index, (output_name, output_data) in enumerate(outputs):
+                    output_name = claim_output_name(output_name, claimed_names)
+                    output_path = os.path.join(output_dir, f"{index}_{output_index}.docx")
+                    with open(output_path, "wb") as f:
+                        f.write(output_data)
+                    output_records.append([output_name, output_path])
+                    zipf.write(output_path, output_name)
+                _update_job_file(
+                    job_id, index,
+                    output_path=output_records[0][1] if output_records else None,
+                    outputs=json.dumps(output_records)
+                )
+        os.replace(f"{result_path}.part", result_path)
+        
+        _update_job(job_id, status="done", finished=time.time(), metrics=_job_metrics(metrics_before))
+    except Exception as e:
+        print(f"Error running job {job_id}: {e}")
+        _update_job(job_id, status="failed", finished=time.time(), error=str(e), metrics=_job_metrics(metrics_before))
+    sop_metrics.write_prometheus_file()
+
+def rerender_job_file(job_id, index, analyses):
+    """
+    Re-render one file of a finished job from edited analyses, without
+    calling the model, and refresh the job's results zip.
+    
+    The analyses are kept with the job's inputs, so they also replace the
+    model's analysis if the job is run again. Raises ValueError if the job
+    or file does not exist or rendering fails.
+    """
+    job = get_job(job_id)
+    if job is None:
+        raise ValueError(f"Unknown job ID: {job_id}")
+    job_file = next((job_file for job_file in job["files"] if job_file["idx"] == index), None)
+    if job_file is None:
+        raise ValueError(f"Job {job_id} has no file {index}")
+    
+    job_dir = _job_dir(job_id)
+    output_dir = os.path.join(job_dir, "outputs")
+    os.makedirs(output_dir, exist_ok=True)
+    outputs = render_from_analyses(job_file["name"], os.path.join(job_dir, "inputs", f"{index}.pdf"), analyses)
+    
+    # Keep the names unique among the other files' outputs
+    claimed_names = {
+        output_name
+        for other_file in job["files"] if other_file["idx"] != index
+        for output_name, _ in other_file["outputs"]
+    }
+    output_records = []
+    for output_index, (output_name, output_data) in enumerate(outputs):
+        output_name = claim_output_name(output_name, claimed_names)
+        output_path = os.path.join(output_dir, f"{index}_{output_index}.docx")
+        with open(output_path, "wb") as f:
+            f.write(output_data)
+        output_records.append([output_name, output_path])
+    with open(_analyses_path(job_id, index), "w", encoding="utf-8") as f:
+        f.write(dump_analysis_json(analyses))
+    _update_job_file(
+        job_id, index,
+        status="done",
+        error=None,
+        analyses=json.dumps(analyses),
+        output_path=output_records[0][1] if output_records else None,
+        outputs=json.dumps(output_records)
+    )
+    
+    job_file["outputs"] = output_records
+    _write_results_zip(job_id, job["files"])
+    return output_records
@@ -0,0 +1,211 @@
+"""
+Process-wide metrics for the SOP pipeline: per-stage timers, counters and
+structured event logs, exported in the Prometheus text format.
+
+Stages are timed with timed("stage") and counted with increment(). Events
+are appended as JSON lines to SOP_METRICS_LOG ("-" for stderr) when set,
+and write_prometheus_file() writes SOP_METRICS_FILE (or a given path) for a
+node_exporter textfile collector or any scraper that reads files.
+
+Metrics recorded in ProcessPoolExecutor workers stay in those processes,
+so the CPU-bound stages are timed by the caller around the pool call.
+"""
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+
+METRICS_LOG = os.getenv("SOP_METRICS_LOG", "")
+METRICS_FILE = os.getenv("SOP_METRICS_FILE", "")
+METRICS_PREFIX = "sop"
+
+_lock = threading.Lock()
+_timers = {}  # stage -> {"count", "seconds", "max"}
+_counters = {}  # (name, ((label, value), ...)) -> value
+_log_lock = threading.Lock()
+
+# Help text for the exported metric families
+_HELP = {
+    "stage_seconds": "Time spent in each pipeline stage.",
+    "stage_seconds_max": "Longest single run of each pipeline stage.",
+    "api_requests_total": "Chat completion requests sent, including retries.",
+    "api_retries_total": "Chat completion requests retried.",
+    "api_rate_limited_total": "Chat completion requests rejected with HTTP 429.",
+    "api_failures_total": "Chat completion requests that failed after retries.",
+    "api_backoff_seconds_total": "Time slept between retries.",
+    "api_throttled_seconds_total": "Time spent waiting for the request/token budgets.",
+    "tokens_total": "Tokens reported in the response usage.",
+    "image_payload_bytes_total": "Encoded process flow image bytes before and after preparation.",
+    "analysis_tiles_total": "Tiles sent for oversized images in tiled analysis.",
+    "analysis_cache_lookups_total": "Analysis cache lookups by result.",
+    "documents_total": "Documents processed by final status.",
+    "documents_low_confidence_total": "Documents analyzed although no image passed the flowchart classifier.",
+    "result_store_lookups_total": "Shared result store lookups by source of the result.",
+}
+
+
+def observe(stage, seconds):
+    """
+    Record one run of a stage.
+    """
+    with _lock:
+        timer = _timers.setdefault(stage, {"count": 0, "seconds": 0.0, "max": 0.0})
+        timer["count"] += 1
+        timer["seconds"] += seconds
+        timer["max"] = max(timer["max"], seconds)
+
+
+@contextlib.contextmanager
+def timed(stage, **fields):
+    """
+    Time the enclosed block as a stage and log it as a "stage" event.
+    """
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        observe(stage, seconds)
+        log_event("stage", stage=stage, seconds=round(seconds, 4), error=error, **fields)
+
+
+def increment(name, value=1, **labels):
+    """
+    Add value to a counter, identified by name and labels.
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def log_event(event, **fields):
+    """
+    Append a structured event to SOP_METRICS_LOG, if configured.
+    """
+    if not METRICS_LOG:
+        return
+    line = json.dumps({"ts": round(time.time(), 3), "event": event, **fields}, default=str)
+    with _log_lock:
+        if METRICS_LOG == "-":
+            print(line, file=sys.stderr)
+        else:
+            with open(METRICS_LOG, 'a', encoding='utf-8') as f:
+                f.write(line + "\n")
+
+
+def _format_key(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+
+
+def snapshot():
+    """
+    Return a JSON-serialisable copy of all timers and counters.
+    """
+    with _lock:
+        return {
+            "timers": {stage: dict(timer) for stage, timer in _timers.items()},
+            "counters": {_format_key(name, labels): value for (name, labels), value in _counters.items()},
+        }
+
+
+def diff(before, after):
+    """
+    Return the metrics recorded between two snapshots.
+
+    The maximum stage duration cannot be subtracted, so the later one is kept.
+    """
+    timers = {}
+    for stage, timer in after["timers"].items():
+        previous = before["timers"].get(stage, {"count": 0, "seconds": 0.0})
+        if timer["count"] > previous["count"]:
+            timers[stage] = {
+                "count": timer["count"] - previous["count"],
+                "seconds": timer["seconds"] - previous["seconds"],
+                "max": timer["max"],
+            }
+    counters = {
+        key: value - before["counters"].get(key, 0)
+        for key, value in after["counters"].items()
+        if value != before["counters"].get(key, 0)
+    }
+    return {"timers": timers, "counters": counters}
+
+
+def summary_rows(metrics):
+    """
+    Flatten a snapshot (or diff) into table rows for display.
+    """
+    rows = [
+        {
+            "Metric": f"{stage} (s)",
+            "Count": timer["count"],
+            "Total": round(timer["seconds"], 3),
+            "Mean": round(timer["seconds"] / timer["count"], 3),
+            "Max": round(timer["max"], 3),
+        }
+        for stage, timer in sorted(metrics["timers"].items())
+    ]
+    rows.extend(
+        {"Metric": key, "Count": None, "Total": round(value, 3), "Mean": None, "Max": None}
+        for key, value in sorted(metrics["counters"].items())
+    )
+
+    lookups = {
+        result: metrics["counters"].get(f'analysis_cache_lookups_total{{result="{result}"}}', 0)
+        for result in ("hit", "miss")
+    }
+    if sum(lookups.values()):
+        rows.append({
+            "Metric": "analysis cache hit rate",
+            "Count": sum(lookups.values()),
+            "Total": round(lookups["hit"] / sum(lookups.values()), 3),
+            "Mean": None,
+            "Max": None,
+        })
+    return rows
+
+
+def render_prometheus(metrics=None):
+    """
+    Render a snapshot (the current one by default) in the Prometheus text format.
+    """
+    metrics = metrics or snapshot()
+    families = {}
+    for stage, timer in sorted(metrics["timers"].items()):
+        families.setdefault(("stage_seconds", "summary"), []).extend([
+            (f'stage_seconds_sum{{stage="{stage}"}}', timer["seconds"]),
+            (f'stage_seconds_count{{stage="{stage}"}}', timer["count"]),
+        ])
+        families.setdefault(("stage_seconds_max", "gauge"), []).append(
+            (f'stage_seconds_max{{stage="{stage}"}}', timer["max"])
+        )
+    for key, value in sorted(metrics["counters"].items()):
+        families.setdefault((key.split("{")[0], "counter"), []).append((key, value))
+
+    lines = []
+    for (name, kind), samples in families.items():
+        lines.append(f"# HELP {METRICS_PREFIX}_{name} {_HELP.get(name, name)}")
+        lines.append(f"# TYPE {METRICS_PREFIX}_{name} {kind}")
+        lines.extend(f"{METRICS_PREFIX}_{key} {value:g}" for key, value in samples)
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus_file(path=None):
+    """
+    Atomically write the current metrics to path (default SOP_METRICS_FILE).
+    """
+    path = path or METRICS_FILE
+    if not path:
+        return
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(render_prometheus())
+    os.replace(temp_path, path)
@@ -0,0 +1,2624 @@
+"""
+Process flow PDF to SOP document pipeline.
+
+Extracts process flow diagrams from PDFs, analyzes them with OpenAI's
+vision model and renders the SOP DOCX. Importing this module neither
+imports streamlit nor creates an OpenAI client; the client is created on
+first use by get_client().
+"""
+import io
+import os
+import re
+import json
+import time
+import hashlib
+import functools
+import threading
+import random
+import collections
+import itertools
+import shutil
+import zipfile
+import tempfile
+import contextlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dotenv import load_dotenv
+import base64
+
+import sop_metrics
+from sop_store import ResultStore
+
+# PyMuPDF (fitz), PIL, python-docx and openai are imported inside the functions
+# that use them. Together they take about a second to import, which would
+# otherwise be paid by every process that imports this module (the CLI, the
+# Streamlit server, pool workers) before it has any file to work on.
+
+load_dotenv()
+
+# Request/token budgets and retry policy for the OpenAI API
+REQUESTS_PER_MINUTE = int(os.getenv("SOP_REQUESTS_PER_MINUTE", "500"))
+TOKENS_PER_MINUTE = int(os.getenv("SOP_TOKENS_PER_MINUTE", "200000"))
+API_MAX_RETRIES = int(os.getenv("SOP_API_MAX_RETRIES", "5"))
+API_BACKOFF_BASE = float(os.getenv("SOP_API_BACKOFF_BASE", "1.0"))
+API_BACKOFF_MAX = float(os.getenv("SOP_API_BACKOFF_MAX", "60.0"))
+# Rough token cost of one image and of the completion, used for budgeting
+# until the response reports actual usage
+IMAGE_TOKEN_ESTIMATE = int(os.getenv("SOP_IMAGE_TOKEN_ESTIMATE", "1500"))
+COMPLETION_TOKEN_ESTIMATE = int(os.getenv("SOP_COMPLETION_TOKEN_ESTIMATE", "2000"))
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+
+# Slots bounding the concurrent API requests of the current batch (see
+# iter_pdf_batch). Requests made from helper threads, e.g. diagrams or tiles
+# analyzed in parallel, take a slot too, so the batch never exceeds its
+# "Concurrent API requests" limit however its work is split up.
+_api_slots = contextvars.ContextVar("api_slots", default=None)
+
+@contextlib.contextmanager
+def api_slot():
+    """
+    Hold one of the current batch's API request slots, if it has any.
+    """
+    slots = _api_slots.get()
+    if slots is None:
+        yield
+        return
+    with slots:
+        yield
+
+def map_in_context(pool, function, items):
+    """
+    Like list(pool.map(function, items)), but each call runs in a copy of
+    the caller's context, so it shares the caller's API slots.
+    """
+    futures = [pool.submit(contextvars.copy_context().run, function, item) for item in items]
+    return [future.result() for future in futures]
+
+
+class RateLimitedClient:
+    """
+    Wrap an OpenAI client with requests/tokens-per-minute budgets and retries.
+    
+    Requests wait until they fit in the rolling one-minute budgets. Retryable
+    failures (timeouts, connection errors, 408/409/429/5xx) are retried with
+    exponential backoff and full jitter, honouring Retry-After headers.
+    Counters are available through counters().
+    """
+
+    def __init__(self, client, requests_per_minute=None, tokens_per_minute=None,
+                 max_retries=None, backoff_base=None, backoff_max=None):
+        self.client = client
+        self.requests_per_minute = REQUESTS_PER_MINUTE if requests_per_minute is None else requests_per_minute
+        self.tokens_per_minute = TOKENS_PER_MINUTE if tokens_per_minute is None else tokens_per_minute
+        self.max_retries = API_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff_base = API_BACKOFF_BASE if backoff_base is None else backoff_base
+        self.backoff_max = API_BACKOFF_MAX if backoff_max is None else backoff_max
+        self._window = collections.deque()  # [timestamp, tokens] per request in the last minute
+        self._condition = threading.Condition()
+        self._counters = collections.Counter()
+
+    def counters(self):
+        """
+        Return a snapshot of the request, retry, throttling and token counters.
+        """
+        with self._condition:
+            return dict(self._counters)
+
+    def _count(self, **increments):
+        with self._condition:
+            self._counters.update(increments)
+        for name, value in increments.items():
+            sop_metrics.increment(f"api_{name}_total", value)
+
+    def _budget_wait(self, now, tokens):
+        while self._window and self._window[0][0] <= now - 60:
+            self._window.popleft()
+        
+        wait = 0.0
+        if self.requests_per_minute and len(self._window) >= self.requests_per_minute:
+            wait = self._window[0][0] + 60 - now
+        
+        if self.tokens_per_minute and self._window:
+            excess = sum(entry[1] for entry in self._window) + tokens - self.tokens_per_minute
+            for timestamp, entry_tokens in self._window:
+                if excess <= 0:
+                    break
+                excess -= entry_tokens
+                wait = max(wait, timestamp + 60 - now)
+        return wait
+
+    def _acquire(self, tokens):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                wait = self._budget_wait(now, tokens)
+                if wait <= 0:
+                    entry = [now, tokens]
+                    self._window.append(entry)
+                    return entry
+                self._counters["throttled_seconds"] += wait
+                sop_metrics.increment("api_throttled_seconds_total", wait)
+                self._condition.wait(wait)
+
+    def _retry_delay(self, error, attempt):
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None) or {}
+        try:
+            if headers.get("retry-after-ms"):
+                return float(headers["retry-after-ms"]) / 1000
+            if headers.get("retry-after"):
+                return float(headers["retry-after"])
+        except ValueError:
+            pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    @staticmethod
+    def is_retryable(error):
+        import openai
+        if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+            return True
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code in RETRYABLE_STATUS_CODES
+        return False
+
+    @staticmethod
+    def estimate_tokens(messages):
+        """
+        Roughly estimate the prompt plus completion tokens of a chat request.
+        """
+        tokens = COMPLETION_TOKEN_ESTIMATE
+        for message in messages:
+            content = message.get("content")
+            parts = content if isinstance(content, list) else [{"type": "text", "text": content or ""}]
+            for part in parts:
+                if part.get("type") == "image_url":
+                    tokens += IMAGE_TOKEN_ESTIMATE
+                else:
+                    tokens += len(part.get("text", "")) // 4
+        return tokens
+
+    def _request(self, kwargs):
+        import openai
+        estimated_tokens = self.estimate_tokens(kwargs.get("messages", []))
+        attempt = 0
+        while True:
+            entry = self._acquire(estimated_tokens)
+            self._count(requests=1)
+            try:
+                return self.client.chat.completions.create(**kwargs), entry
+            except Exception as e:
+                if isinstance(e, openai.RateLimitError):
+                    self._count(rate_limited=1)
+                if not self.is_retryable(e) or attempt >= self.max_retries:
+                    self._count(failures=1)
+                    raise
+                delay = self._retry_delay(e, attempt)
+                self._count(retries=1, backoff_seconds=delay)
+                print(f"Retrying OpenAI request in {delay:.1f}s after error: {e}")
+                sop_metrics.log_event("api_retry", attempt=attempt + 1, delay=round(delay, 3), error=str(e))
+                time.sleep(delay)
+                attempt += 1
+
+    def _record_usage(self, entry, usage):
+        if usage is None:
+            return
+        with self._condition:
+            entry[1] = usage.total_tokens
+            self._counters["prompt_tokens"] += usage.prompt_tokens
+            self._counters["completion_tokens"] += usage.completion_tokens
+            self._condition.notify_all()
+        sop_metrics.increment("tokens_total", usage.prompt_tokens, kind="prompt")
+        sop_metrics.increment("tokens_total", usage.completion_tokens, kind="completion")
+
+    def create_chat_completion(self, **kwargs):
+        """
+        Call chat.completions.create within the budgets, retrying retryable errors.
+        """
+        with api_slot(), sop_metrics.timed("api_call", model=kwargs.get("model")):
+            response, entry = self._request(kwargs)
+        self._record_usage(entry, getattr(response, "usage", None))
+        return response
+
+    def stream_chat_completion(self, **kwargs):
+        """
+        Stream a chat completion, yielding content deltas as they arrive.
+        
+        Retries apply to opening the stream; errors after the first chunk
+        are raised to the caller.
+        """
+        kwargs = dict(kwargs, stream=True, stream_options={"include_usage": True})
+        with api_slot(), sop_metrics.timed("api_call", model=kwargs.get("model"), stream=True):
+            stream, entry = self._request(kwargs)
+            for chunk in stream:
+                self._record_usage(entry, getattr(chunk, "usage", None))
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+
+class StepStreamParser:
+    """
+    Incrementally scan streamed analysis JSON and return each object of the
+    top-level "steps" array as soon as its closing brace arrives.
+    """
+
+    def __init__(self):
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._string = []
+        self._last_key = None
+        self._steps_depth = None
+        self._step_chars = None
+
+    def feed(self, text):
+        """
+        Consume the next chunk of text and return the steps it completed.
+        """
+        steps = []
+        for ch in text:
+            if self._step_chars is not None:
+                self._step_chars.append(ch)
+            
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_key = "".join(self._string)
+                elif self._depth == 1:
+                    self._string.append(ch)
+                continue
+            
+            if ch == '"':
+                self._in_string = True
+                self._string = []
+            elif ch in "{[":
+                self._depth += 1
+                if ch == "[" and self._depth == 2 and self._last_key == "steps":
+                    self._steps_depth = self._depth
+                elif ch == "{" and self._steps_depth and self._depth == self._steps_depth + 1:
+                    self._step_chars = ["{"]
+            elif ch in "}]":
+                if ch == "}" and self._step_chars is not None and self._depth == self._steps_depth + 1:
+                    step_text = "".join(self._step_chars)
+                    self._step_chars = None
+                    try:
+                        step = json.loads(step_text)
+                    except json.JSONDecodeError:
+                        step = repair_json(step_text)
+                    if step is not None:
+                        steps.append(step)
+                elif ch == "]" and self._depth == self._steps_depth:
+                    self._steps_depth = None
+                self._depth -= 1
+        return steps
+
+
+# OpenAI client, created on first use (you'll need to set OPENAI_API_KEY in your environment variables).
+# Retries are handled by RateLimitedClient, so the SDK's own retries are disabled.
+# OPENAI_BASE_URL can point the client at a local OpenAI-compatible server.
+_client = None
+_client_lock = threading.Lock()
+
+def create_client():
+    """
+    Build the rate-limited OpenAI client from the environment.
+    """
+    from openai import OpenAI
+    api_key = os.getenv("OPENAI_API_KEY")
+    return RateLimitedClient(OpenAI(api_key=api_key, max_retries=0))
+
+def get_client():
+    """
+    Return the shared client, creating it on first use.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = create_client()
+        return _client
+
+def get_client_counters():
+    """
+    Return the shared client's counters, or {} if no client has been created
+    (unlike get_client(), this never creates one).
+    """
+    with _client_lock:
+        client = _client
+    return client.counters() if client is not None else {}
+
+def set_client(client):
+    """
+    Replace the shared client (e.g. with one pointed at a test server).
+    """
+    global _client
+    with _client_lock:
+        _client = client
+
+# Finished documents are kept in a process-wide ResultStore (see sop_store),
+# keyed by PDF content and settings, so a PDF submitted by several users or
+# sessions, or twice in one batch, is analyzed and rendered only once.
+_result_store = None
+_result_store_lock = threading.Lock()
+
+def get_result_store():
+    """
+    Return the shared result store, creating it on first use.
+    """
+    global _result_store
+    with _result_store_lock:
+        if _result_store is None:
+            _result_store = ResultStore()
+        return _result_store
+
+def set_result_store(store):
+    """
+    Replace the shared result store (e.g. with one without memory for benchmarks).
+    """
+    global _result_store
+    with _result_store_lock:
+        _result_store = store
+
+# Define paths for reference files. The default set lives directly in
+# References/; additional named sets (different SOP styles) live in
+# References/<name>/ with the same file names.
+REFERENCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "References")
+REFERENCE_IMAGE_NAME = "ref_image.png"
+REFERENCE_TEXT_NAME = "ref_output.txt"
+DEFAULT_REFERENCE_SET = "default"
+REFERENCE_IMAGE_PATH = os.path.join(REFERENCE_DIR, REFERENCE_IMAGE_NAME)
+REFERENCE_TEXT_PATH = os.path.join(REFERENCE_DIR, REFERENCE_TEXT_NAME)
+_reference_cache = {}
+_reference_cache_lock = threading.Lock()
+
+# Concurrency limits for batch processing. API workers bound the number of
+# simultaneous vision calls (keep this under the account's rate limit), CPU
+# workers run PDF extraction and DOCX rendering in separate processes.
+# Those are started from a clean forkserver process (spawned where that is
+# unavailable) rather than forked from this one: the Streamlit server and
+# job threads may hold locks (stdout, sqlite, the DOCX template) at fork
+# time, which would stay locked forever in a forked worker.
+MAX_API_WORKERS = int(os.getenv("SOP_MAX_API_WORKERS", "4"))
+MAX_CPU_WORKERS = int(os.getenv("SOP_MAX_CPU_WORKERS", str(os.cpu_count() or 1)))
+
+# On-disk cache of parsed analysis JSON, keyed by image, reference, prompt and model
+ANALYSIS_CACHE_DIR = os.getenv("SOP_CACHE_DIR", ".sop_cache")
+ANALYSIS_CACHE_MAX_BYTES = int(os.getenv("SOP_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+ANALYSIS_CACHE_MAX_AGE = float(os.getenv("SOP_CACHE_MAX_AGE_DAYS", "30")) * 24 * 3600
+_analysis_cache_lock = threading.Lock()
+
+# Preprocessing applied to the process flow image before the vision call
+MAX_IMAGE_DIMENSION = int(os.getenv("SOP_MAX_IMAGE_DIMENSION", "2048"))
+IMAGE_DETAIL = os.getenv("SOP_IMAGE_DETAIL", "auto")  # "low", "high" or "auto"
+IMAGE_FORMAT = os.getenv("SOP_IMAGE_FORMAT", "auto")  # "png", "jpeg" or "auto"
+JPEG_QUALITY = int(os.getenv("SOP_JPEG_QUALITY", "85"))
+# Diagrams with at most this many distinct colours compress better as PNG
+LINE_ART_MAX_COLORS = 256
+
+# Tiled analysis (SOP_TILED_ANALYSIS=1): images with more than TILE_MIN_PIXELS
+# pixels, which would lose detail when downscaled for the vision call, are
+# split into TILE_SIZE tiles overlapping by TILE_OVERLAP of their size. The
+# tiles and a TILE_OVERVIEW_DIMENSION overview of the whole diagram are
+# analyzed concurrently by up to MAX_TILE_WORKERS threads and the partial
+# step lists merged into one analysis. Smaller images take the single call.
+TILED_ANALYSIS = os.getenv("SOP_TILED_ANALYSIS", "0") == "1"
+TILE_MIN_PIXELS = int(os.getenv("SOP_TILE_MIN_PIXELS", str(3000 * 3000)))
+TILE_SIZE = int(os.getenv("SOP_TILE_SIZE", "2048"))
+TILE_OVERLAP = float(os.getenv("SOP_TILE_OVERLAP", "0.15"))
+TILE_OVERVIEW_DIMENSION = int(os.getenv("SOP_TILE_OVERVIEW_DIMENSION", "1024"))
+MAX_TILE_WORKERS = int(os.getenv("SOP_MAX_TILE_WORKERS", "4"))
+# Steps from different tiles with the same role whose task text is at least
+# this similar are merged
+TILE_STEP_SIMILARITY = 0.9
+
+# Image extraction: embedded images smaller than MIN_IMAGE_AREA pixels are
+# ignored, images inside the top/bottom HEADER_FOOTER_BAND of a page are
+# ranked down, and vector-drawn pages are rendered at PAGE_RENDER_DPI.
+MIN_IMAGE_AREA = int(os.getenv("SOP_MIN_IMAGE_AREA", str(150 * 150)))
+HEADER_FOOTER_BAND = 0.12
+MIN_VECTOR_DRAWINGS = int(os.getenv("SOP_MIN_VECTOR_DRAWINGS", "20"))
+PAGE_RENDER_DPI = int(os.getenv("SOP_PAGE_RENDER_DPI", "150"))
+
+# Flowchart pre-classification: the CLASSIFY_MAX_CANDIDATES best ranked
+# images are scored locally (0 to 1) from a CLASSIFIER_SIZE thumbnail, with
+# box edges counted at CLASSIFIER_LINE_SIZE so the count does not depend on
+# the image's size. Box edges are pixels differing from the background by
+# more than CLASSIFIER_INK_CONTRAST grey levels, so outlined and filled
+# boxes on white, tinted or scanned pages all count. Images scoring at
+# least FLOWCHART_MIN_SCORE are analyzed, best first. When none does,
+# LOW_CONFIDENCE_POLICY "flag" stops the document before any API call;
+# "send" logs it and analyzes the best scoring image anyway. Reference
+# images should score well above the threshold at CLASSIFIER_CHECK_WIDTHS
+# (see validate_reference_sets).
+CLASSIFY_MAX_CANDIDATES = int(os.getenv("SOP_CLASSIFY_MAX_CANDIDATES", "8"))
+FLOWCHART_MIN_SCORE = float(os.getenv("SOP_FLOWCHART_MIN_SCORE", "0.4"))
+LOW_CONFIDENCE_POLICY = os.getenv("SOP_LOW_CONFIDENCE_POLICY", "flag")
+CLASSIFIER_SIZE = 256
+CLASSIFIER_LINE_SIZE = 512
+CLASSIFIER_INK_CONTRAST = 16
+CLASSIFIER_CHECK_WIDTHS = (500, 700, 1000, 1200, 1600, 2000)
+
+# Several process flows per PDF: "off" analyzes only the best ranked image,
+# "merge" combines all diagrams into one SOP with ordered sections and
+# "split" writes one DOCX per diagram. Diagrams are analyzed concurrently,
+# or IMAGES_PER_REQUEST at a time in one request when that is set above 1
+# (the reference payload is then sent once per group instead of per image).
+MULTI_FLOWCHART_MODE = os.getenv("SOP_MULTI_FLOWCHART_MODE", "off")
+MAX_FLOWCHARTS_PER_PDF = int(os.getenv("SOP_MAX_FLOWCHARTS_PER_PDF", "10"))
+MAX_DIAGRAM_WORKERS = int(os.getenv("SOP_MAX_DIAGRAM_WORKERS", "2"))
+IMAGES_PER_REQUEST = int(os.getenv("SOP_IMAGES_PER_REQUEST", "1"))
+
+# Resumable batches: process_pdf_files keeps a manifest (content hash, stage,
+# status and outputs of every PDF) and the finished DOCX files in a directory
+# under BATCH_DIR named after the batch's file names, so re-submitting the
+# same batch only processes new, changed or failed documents. Batch
+# directories untouched for BATCH_MAX_AGE are removed; an empty BATCH_DIR
+# keeps each batch in a temporary directory instead.
+BATCH_DIR = os.getenv("SOP_BATCH_DIR", ".sop_batches")
+BATCH_MAX_AGE = float(os.getenv("SOP_BATCH_MAX_AGE_DAYS", "7")) * 24 * 3600
+MANIFEST_NAME = "manifest.json"
+
+# Large uploads: ZIP members are read one at a time (and copied to disk
+# when a spool directory is given) instead of extracting whole archives,
+# and PDFs on disk are passed to the workers by path. Output archives stay
+# in memory up to SPOOL_MAX_MEMORY bytes and spill to a temporary file
+# beyond that. Archives exceeding the ZIP_MAX_* limits, or with a member
+# compressed more than ZIP_MAX_RATIO times, are rejected as zip bombs.
+SPOOL_MAX_MEMORY = int(os.getenv("SOP_SPOOL_MAX_MEMORY", str(64 * 1024 * 1024)))
+ZIP_MAX_MEMBERS = int(os.getenv("SOP_ZIP_MAX_MEMBERS", "5000"))
+ZIP_MAX_MEMBER_BYTES = int(os.getenv("SOP_ZIP_MAX_MEMBER_BYTES", str(512 * 1024 * 1024)))
+ZIP_MAX_TOTAL_BYTES = int(os.getenv("SOP_ZIP_MAX_TOTAL_BYTES", str(8 * 1024 * 1024 * 1024)))
+ZIP_MAX_RATIO = float(os.getenv("SOP_ZIP_MAX_RATIO", "100"))
+
+# Cached DOCX skeletons, keyed by whether the document has a title page
+_docx_templates = {}
+_docx_template_lock = threading.Lock()
+
+MODEL_NAME = "gpt-4o-mini"
+SYSTEM_MESSAGE = "You are an expert at analyzing process flow diagrams and converting them into detailed text descriptions."
+ANALYSIS_PROMPT = """Analyze this process flow diagram. 
+            Describe the steps in detail in such a way that it is shown in the "Output Format".
+            Use the Output Format given above for generating a response.
+            Generate an Objective and also the Purpose for the processflow(Image) in 3-4 sentences.
+            The steps should be ordered in such a way that the processflow image is there.
+            Consider all possible flows if there are multiple options after a step create a and b for those steps.
+            So understand the pattern and generate the response based on the "Output Format".
+            Fix the output format and dont deviate from it.
+            Consider all the boxes in the Image as Step and Create sub steps for each step similar to that of Output Reference.
+            In the details step try to add as many steps as possible for each substep.
+            Do not consider reference text as the input it is just for understanding the output 
+            Do not use the reference text in the output
+            IMPORTANT: Provide the response in valid JSON format with the following structure:
+            {
+              "title": "...",
+              "Objective": "...",
+              "purpose": "...",
+              "steps": [
+                {
+                  "step": "...",
+                  "role": "...",
+                  "activities": [
+                    {
+                      "task": "...",
+                      "details": [
+                        "...",
+                        "..."
+                      ]
+                    }
+                  ]
+                }
+              ]
+            }"""
+
+# Stream completions when a caller wants live step previews
+STREAM_RESPONSES = os.getenv("SOP_STREAM_RESPONSES", "1") == "1"
+
+# Structured output: constrain the response to this schema (SOP_STRUCTURED_OUTPUT=0
+# falls back to free-form JSON parsing for models/servers without json_schema support)
+STRUCTURED_OUTPUT = os.getenv("SOP_STRUCTURED_OUTPUT", "1") == "1"
+ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string"},
+        "Objective": {"type": "string"},
+        "purpose": {"type": "string"},
+        "steps": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "step": {"type": "string"},
+                    "role": {"type": "string"},
+                    "activities": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "task": {"type": "string"},
+                                "details": {"type": "array", "items": {"type": "string"}}
+                            },
+                            "required": ["task", "details"],
+                            "additionalProperties": False
+                        }
+                    }
+                },
+                "required": ["step", "role", "activities"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["title", "Objective", "purpose", "steps"],
+    "additionalProperties": False
+}
+BATCH_ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {"diagrams": {"type": "array", "items": ANALYSIS_SCHEMA}},
+    "required": ["diagrams"],
+    "additionalProperties": False
+}
+BATCH_ANALYSIS_PROMPT = (
+    "There are {count} separate process flow diagrams after this message. "
+    "Analyze each one independently as described above and respond with a JSON "
+    'object {{"diagrams": [...]}} holding one analysis object per diagram, in '
+    "the order the diagrams are given."
+)
+TILE_ANALYSIS_PROMPT = (
+    "This image is tile {index} of {count} (row {row}, column {column}) cut from a "
+    "larger process flow diagram; neighbouring tiles overlap by a margin. Analyze "
+    "only the steps whose boxes are visible in this tile, in the order they appear, "
+    "and copy box labels and roles exactly as written. Do not guess steps that are "
+    "cut off at the edges; they are analyzed in the neighbouring tile."
+)
+JSON_REASK_PROMPT = (
+    "The text below was meant to be a single JSON object with the keys "
+    '"title", "Objective", "purpose" and "steps" (each step has "step", "role" '
+    'and "activities"; each activity has "task" and "details"). It is not valid '
+    "JSON. Return only the corrected JSON object, keeping all of its content."
+)
+
+def encode_image_to_base64(image):
+    """
+    Convert PIL Image to base64 for OpenAI API.
+    """
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
+    return img_str
+
+def choose_image_format(image):
+    """
+    Pick PNG for flat line art and JPEG for photographic/scanned content.
+    """
+    if IMAGE_FORMAT in ("png", "jpeg"):
+        return IMAGE_FORMAT.upper()
+    if image.mode in ("RGBA", "LA") or "transparency" in image.info:
+        return "PNG"
+    sample = image.copy()
+    sample.thumbnail((256, 256))
+    colors = sample.convert("RGB").getcolors(maxcolors=LINE_ART_MAX_COLORS)
+    return "PNG" if colors is not None else "JPEG"
+
+def prepare_image_for_api(image, max_dimension=None, image_format=None):
+    """
+    Downscale and compress an image for the vision call.
+    
+    Returns a dict with the base64 payload, its MIME type and the encoded
+    size before (full-resolution PNG, as sent previously) and after.
+    """
+    from PIL import Image
+    max_dimension = max_dimension or MAX_IMAGE_DIMENSION
+    image_format = image_format or choose_image_format(image)
+    
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    bytes_before = buffered.tell()
+    
+    prepared = image
+    if max(image.size) > max_dimension:
+        prepared = image.copy()
+        prepared.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    
+    if image_format == "PNG" and prepared is image:
+        data = buffered.getvalue()
+    else:
+        buffered = io.BytesIO()
+        if image_format == "JPEG":
+            prepared.convert("RGB").save(buffered, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        else:
+            prepared.save(buffered, format="PNG", optimize=True)
+        data = buffered.getvalue()
+    
+    return {
+        "base64": base64.b64encode(data).decode('utf-8'),
+        "mime_type": f"image/{image_format.lower()}",
+        "size": prepared.size,
+        "bytes_before": bytes_before,
+        "bytes_after": len(data),
+    }
+
+def _file_mtime(path):
+    try:
+        return os.path.getmtime(path) if path else None
+    except OSError:
+        return None
+
+def _build_reference_context(reference_image_path, reference_text_path):
+    from PIL import Image
+    hasher = hashlib.sha256()
+    content = []
+    
+    # Add reference image if provided
+    if reference_image_path and os.path.exists(reference_image_path):
+        with open(reference_image_path, 'rb') as ref_file:
+            ref_image_bytes = ref_file.read()
+        hasher.update(ref_image_bytes)
+        ref_image = Image.open(io.BytesIO(ref_image_bytes))
+        ref_image_base64 = encode_image_to_base64(ref_image)
+        content.append({
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:image/png;base64,{ref_image_base64}"
+            }
+        })
+        content.append({
+            "type": "text",
+            "text": "Additional Context: Here is a reference image for additional context:"
+        })
+    hasher.update(b"\0")
+    
+    # Add reference text if provided
+    if reference_text_path and os.path.exists(reference_text_path):
+        with open(reference_text_path, 'r', encoding='utf-8') as file:
+            reference_text = file.read()
+        hasher.update(reference_text.encode('utf-8'))
+        content.append({
+            "type": "text",
+            "text": f"Output Format:\n{reference_text}"
+        })
+    hasher.update(b"\0")
+    
+    return {"content": content, "digest": hasher.hexdigest()}
+
+def load_reference_context(reference_image_path=None, reference_text_path=None):
+    """
+    Return the encoded reference payload for a pair of reference files.
+    
+    The payload is built once per process and rebuilt only when either
+    file's modification time changes.
+    """
+    key = (reference_image_path, reference_text_path)
+    mtimes = (_file_mtime(reference_image_path), _file_mtime(reference_text_path))
+    with _reference_cache_lock:
+        cached = _reference_cache.get(key)
+        if cached and cached[0] == mtimes:
+            return cached[1]
+        context = _build_reference_context(reference_image_path, reference_text_path)
+        _reference_cache[key] = (mtimes, context)
+        return context
+
+def list_reference_sets():
+    """
+    Return the available reference sets as {name: (image_path, text_path)}.
+    """
+    reference_sets = {DEFAULT_REFERENCE_SET: (REFERENCE_IMAGE_PATH, REFERENCE_TEXT_PATH)}
+    if os.path.isdir(REFERENCE_DIR):
+        for name in sorted(os.listdir(REFERENCE_DIR)):
+            set_dir = os.path.join(REFERENCE_DIR, name)
+            if os.path.isdir(set_dir):
+                reference_sets[name] = (
+                    os.path.join(set_dir, REFERENCE_IMAGE_NAME),
+                    os.path.join(set_dir, REFERENCE_TEXT_NAME)
+                )
+    return reference_sets
+
+def get_reference_paths(reference_set=None):
+    """
+    Resolve a reference set name to its (image_path, text_path).
+    """
+    reference_sets = list_reference_sets()
+    name = reference_set or DEFAULT_REFERENCE_SET
+    if name not in reference_sets:
+        raise ValueError(f"Unknown reference set: {name}")
+    return reference_sets[name]
+
+def validate_reference_sets():
+    """
+    Check every reference set can be loaded and return a list of problems.
+    """
+    problems = []
+    for name, (image_path, text_path) in list_reference_sets().items():
+        if not os.path.exists(image_path):
+            problems.append(f"{name}: missing reference image {image_path}")
+        if not os.path.exists(text_path):
+            problems.append(f"{name}: missing reference text {text_path}")
+        try:
+            load_reference_context(image_path, text_path)
+            problems.extend(f"{name}: {problem}" for problem in check_flowchart_classifier(image_path))
+        except Exception as e:
+            problems.append(f"{name}: {e}")
+    return problems
+
+def check_flowchart_classifier(image_path):
+    """
+    Score a known process flow diagram (e.g. a reference image) at the
+    CLASSIFIER_CHECK_WIDTHS it fits in and return a problem for each width
+    at which it would not pass FLOWCHART_MIN_SCORE.
+    """
+    from PIL import Image
+    if not os.path.exists(image_path):
+        return []
+    with Image.open(image_path) as image:
+        image = image.convert("RGB")
+    problems = []
+    for width in CLASSIFIER_CHECK_WIDTHS:
+        if width > image.size[0]:
+            continue
+        resized = image.resize((width, max(1, round(image.size[1] * width / image.size[0]))), Image.LANCZOS)
+        score = flowchart_score(resized)
+        if score < FLOWCHART_MIN_SCORE:
+            problems.append(
+                f"reference image scores {score:.2f} at {width}px, below the flowchart "
+                f"threshold {FLOWCHART_MIN_SCORE:.2f}"
+            )
+    return problems
+
+def analysis_cache_key(image, reference_digest="", variant=""):
+    """
+    Build the content hash that identifies an analysis result.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(f"{image.mode}:{image.size[0]}x{image.size[1]}\0".encode('utf-8'))
+    hasher.update(image.tobytes())
+    hasher.update(b"\0")
+    hasher.update(reference_digest.encode('utf-8') + b"\0")
+    hasher.update(variant.encode('utf-8') + b"\0")
+    hasher.update(SYSTEM_MESSAGE.encode('utf-8') + b"\0")
+    hasher.update(ANALYSIS_PROMPT.encode('utf-8') + b"\0")
+    hasher.update(MODEL_NAME.encode('utf-8'))
+    return hasher.hexdigest()
+
+def _analysis_cache_path(key):
+    return os.path.join(ANALYSIS_CACHE_DIR, f"{key}.json")
+
+def load_cached_analysis(key):
+    """
+    Return the cached analysis JSON for a key, or None if missing or expired.
+    """
+    if not ANALYSIS_CACHE_DIR:
+        return None
+    cache_path = _analysis_cache_path(key)
+    try:
+        if time.time() - os.path.getmtime(cache_path) > ANALYSIS_CACHE_MAX_AGE:
+            os.remove(cache_path)
+            sop_metrics.increment("analysis_cache_lookups_total", result="miss")
+            return None
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            analysis = json.load(f)
+        if not is_analysis(analysis):
+            # Written before responses without steps were rejected
+            os.remove(cache_path)
+            sop_metrics.increment("analysis_cache_lookups_total", result="miss")
+            return None
+        # Touch the entry so eviction keeps recently used results
+        os.utime(cache_path)
+        sop_metrics.increment("analysis_cache_lookups_total", result="hit")
+        return analysis
+    except (OSError, json.JSONDecodeError):
+        sop_metrics.increment("analysis_cache_lookups_total", result="miss")
+        return None
+
+def store_cached_analysis(key, analysis):
+    """
+    Persist an analysis result and evict old entries if the cache is too big.
+    Anything that is not an analysis (no steps list) is never stored.
+    """
+    if not ANALYSIS_CACHE_DIR or not is_analysis(analysis):
+        return
+    try:
+        os.makedirs(ANALYSIS_CACHE_DIR, exist_ok=True)
+        cache_path = _analysis_cache_path(key)
+        temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(analysis, f)
+        os.replace(temp_path, cache_path)
+        evict_analysis_cache()
+    except OSError as e:
+        print(f"Error writing analysis cache: {e}")
+
+def evict_analysis_cache():
+    """
+    Drop expired entries, then least recently used ones until under the size limit.
+    """
+    with _analysis_cache_lock:
+        entries = []
+        now = time.time()
+        for filename in os.listdir(ANALYSIS_CACHE_DIR):
+            if not filename.endswith('.json'):
+                continue
+            cache_path = os.path.join(ANALYSIS_CACHE_DIR, filename)
+            try:
+                stat = os.stat(cache_path)
+                if now - stat.st_mtime > ANALYSIS_CACHE_MAX_AGE:
+                    os.remove(cache_path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, cache_path))
+            except OSError:
+                pass
+        
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, cache_path in sorted(entries):
+            if total_size <= ANALYSIS_CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(cache_path)
+                total_size -= size
+            except OSError:
+                pass
+
+def _structured_output_kwargs(schema=None, name="sop_analysis"):
+    if not STRUCTURED_OUTPUT:
+        return {}
+    return {
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": name, "strict": True, "schema": schema or ANALYSIS_SCHEMA}
+        }
+    }
+
+def _strip_trailing_comma(chars):
+    while chars and chars[-1].isspace():
+        chars.pop()
+    if chars and chars[-1] == ",":
+        chars.pop()
+
+def repair_json(text, required_key=None):
+    """
+    Best-effort parse of sloppy or truncated JSON, returning the object or None.
+    
+    Scans from the first "{" in a single pass, dropping trailing commas and
+    anything after the top-level object closes. If the text ends early,
+    open strings and containers are closed; if that still does not parse,
+    the last incomplete element is dropped. If the object found does not
+    parse (e.g. prose like "Note {see below}." before the JSON), or lacks
+    required_key when one is given, the scan restarts at the next "{"
+    after it.
+    """
+    start = text.find("{")
+    while start >= 0:
+        result, end = _repair_json_from(text, start)
+        if result is not None and (required_key is None or required_key in result):
+            return result
+        if end is None:
+            # The text ended inside the object, so no later object is complete
+            return None
+        start = text.find("{", end)
+    return None
+
+def _repair_json_from(text, start):
+    # Returns (object or None, index after the object, or None if the text
+    # ended before it closed)
+    end = None
+    chars = []
+    stack = []
+    # (length of chars, open containers) after each complete element
+    checkpoints = []
+    in_string = False
+    escaped = False
+    for index in range(start, len(text)):
+        ch = text[index]
+        if in_string:
+            chars.append(ch)
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        
+        if ch == '"':
+            in_string = True
+            chars.append(ch)
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+            chars.append(ch)
+            checkpoints.append((len(chars), list(stack)))
+        elif ch in "}]":
+            if not stack:
+                break
+            _strip_trailing_comma(chars)
+            chars.append(stack.pop())
+            if not stack:
+                end = index + 1
+                break
+        elif ch == ",":
+            checkpoints.append((len(chars), list(stack)))
+            chars.append(ch)
+        else:
+            chars.append(ch)
+    
+    candidates = []
+    if not stack and not in_string:
+        candidates.append("".join(chars))
+    else:
+        tail = chars + (['"'] if in_string else [])
+        _strip_trailing_comma(tail)
+        candidates.append("".join(tail) + "".join(reversed(stack)))
+        for length, open_stack in reversed(checkpoints):
+            tail = chars[:length]
+            _strip_trailing_comma(tail)
+            candidates.append("".join(tail) + "".join(reversed(open_stack)))
+    
+    for candidate in candidates:
+        try:
+            result = json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(result, dict):
+            return result, end
+    return None, end
+
+def is_analysis(result, required_key="steps"):
+    """
+    Whether a parsed response is an analysis, i.e. a dict with a list under
+    required_key (a refusal or a response cut off before its steps is not).
+    """
+    return isinstance(result, dict) and isinstance(result.get(required_key), list)
+
+def parse_analysis_response(response_text, required_key="steps"):
+    """
+    Parse the model's analysis JSON: as-is, from a ```json block, or repaired.
+    
+    Returns None unless the result is a dict with a list under required_key
+    ("diagrams" for batched responses), so callers treat anything else as
+    a failed parse.
+    """
+    try:
+        # First attempt: Try to parse the entire response as JSON
+        analysis = json.loads(response_text)
+        if is_analysis(analysis, required_key):
+            return analysis
+    except json.JSONDecodeError:
+        pass
+    
+    # Second attempt: Try to find JSON content between markers
+    start_marker = "```json"
+    end_marker = "```"
+    if start_marker in response_text:
+        json_content = response_text.split(start_marker)[1].split(end_marker)[0].strip()
+        try:
+            analysis = json.loads(json_content)
+            if is_analysis(analysis, required_key):
+                return analysis
+        except json.JSONDecodeError:
+            pass
+    
+    # Last attempt: Repair truncated or slightly malformed JSON
+    analysis = repair_json(response_text, required_key)
+    return analysis if is_analysis(analysis, required_key) else None
+
+def reask_for_valid_json(response_text):
+    """
+    Send only the malformed response text back to the model and parse the correction.
+    """
+    if not response_text:
+        return None
+    try:
+        response = get_client().create_chat_completion(
+            model=MODEL_NAME,
+            messages=[
+                {"role": "system", "content": "You convert malformed output into valid JSON without changing its content."},
+                {"role": "user", "content": f"{JSON_REASK_PROMPT}\n\n{response_text}"}
+            ],
+            **_structured_output_kwargs()
+        )
+        return parse_analysis_response((response.choices[0].message.content or "").strip())
+    except Exception as e:
+        print(f"Error re-asking for valid JSON: {e}")
+        return None
+
+def _analysis_variant():
+    # The preprocessing settings change what the model sees, so they are part of the key
+    variant = f"{MAX_IMAGE_DIMENSION}:{IMAGE_FORMAT}:{IMAGE_DETAIL}:{STRUCTURED_OUTPUT}"
+    if TILED_ANALYSIS:
+        variant += f":tiled:{TILE_MIN_PIXELS}:{TILE_SIZE}:{TILE_OVERLAP}:{TILE_OVERVIEW_DIMENSION}"
+    return variant
+
+def _image_content_part(image):
+    """
+    Downscale and compress an image and return it as an image_url content part.
+    """
+    with sop_metrics.timed("encode_image"):
+        prepared = prepare_image_for_api(image)
+    sop_metrics.increment("image_payload_bytes_total", prepared["bytes_before"], kind="before")
+    sop_metrics.increment("image_payload_bytes_total", prepared["bytes_after"], kind="after")
+    sop_metrics.log_event(
+        "image_payload",
+        bytes_before=prepared["bytes_before"],
+        bytes_after=prepared["bytes_after"],
+        mime_type=prepared["mime_type"],
+        size=list(prepared["size"]),
+        detail=IMAGE_DETAIL,
+    )
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:{prepared['mime_type']};base64,{prepared['base64']}",
+            "detail": IMAGE_DETAIL
+        }
+    }
+
+def needs_tiling(image):
+    """
+    Whether an image is analyzed in tiles (SOP_TILED_ANALYSIS on and the image is large enough).
+    """
+    return TILED_ANALYSIS and image.size[0] * image.size[1] > TILE_MIN_PIXELS
+
+def analyze_process_flow_image(image, reference_image_path=None, reference_text_path=None, use_cache=True, on_step=None,
+                               tile_prompt=None):
+    """
+    Analyze a process flow image using OpenAI's vision model.
+    Results are served from the on-disk cache when the same image, references,
+    prompt and model were analyzed before.
+    
+    If on_step is given (and SOP_STREAM_RESPONSES is on) the completion is
+    streamed and on_step is called with each step object as soon as it is
+    complete, for live previews. Images for which needs_tiling() is true
+    are analyzed by analyze_tiled_image instead, and their steps passed to
+    on_step once merged. tile_prompt is appended to the prompt when the
+    image is one tile of a larger diagram (an empty one only disables tiling).
+    """
+    try:
+        reference_context = load_reference_context(reference_image_path, reference_text_path)
+        tiled = tile_prompt is None and needs_tiling(image)
+        variant = _analysis_variant() + (f":{tile_prompt}" if tile_prompt else "") + (":merged" if tiled else "")
+        cache_key = analysis_cache_key(image, reference_context["digest"], variant)
+        if use_cache:
+            cached = load_cached_analysis(cache_key)
+            if cached is not None:
+                if on_step is not None and isinstance(cached.get("steps"), list):
+                    for step in cached["steps"]:
+                        on_step(step)
+                return cached
+        
+        if tiled:
+            analysis = analyze_tiled_image(image, reference_image_path, reference_text_path, use_cache=use_cache)
+            if analysis is None:
+                return None
+            if on_step is not None:
+                for step in analysis["steps"]:
+                    on_step(step)
+            if use_cache:
+                store_cached_analysis(cache_key, analysis)
+            return analysis
+        
+        # Prepare system message and content, starting from the shared reference payload
+        content = list(reference_context["content"])
+        system_message = SYSTEM_MESSAGE
+
+        # Add analysis instructions and image
+        content.append({
+            "type": "text", 
+            "text": ANALYSIS_PROMPT
+        })
+        if tile_prompt:
+            content.append({"type": "text", "text": tile_prompt})
+        
+        content.append(_image_content_part(image))
+
+        # Generate response using OpenAI
+        request = dict(
+            model=MODEL_NAME,
+            messages=[
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": content}
+            ],
+            **_structured_output_kwargs()
+        )
+        if on_step is not None and STREAM_RESPONSES:
+            step_parser = StepStreamParser()
+            response_parts = []
+            for delta in get_client().stream_chat_completion(**request):
+                response_parts.append(delta)
+                for step in step_parser.feed(delta):
+                    on_step(step)
+            response_text = "".join(response_parts).strip()
+        else:
+            response = get_client().create_chat_completion(**request)
+            response_text = (response.choices[0].message.content or "").strip()
+        with sop_metrics.timed("parse_json"):
+            analysis = parse_analysis_response(response_text)
+        
+        if analysis is None:
+            # Ask again with only the text, which is much cheaper than resending the image
+            print("Response was not a valid analysis, asking the model to correct it")
+            analysis = reask_for_valid_json(response_text)
+        
+        if analysis is None:
+            print("Error parsing JSON content: no analysis with a steps list found in response")
+            print("Raw response:", response_text)
+            return None
+        
+        if use_cache:
+            store_cached_analysis(cache_key, analysis)
+        return analysis
+    
+    except Exception as e:
+        print(f"Error analyzing image with OpenAI: {e}")
+        sop_metrics.log_event("error", stage="analyze", error=str(e))
+        return None
+
+def analyze_process_flow_images_batched(images, reference_image_path=None, reference_text_path=None):
+    """
+    Analyze several process flow images in a single request.
+    
+    Returns a list of analyses aligned with images (None where one failed).
+    Results are read from and written to the per-image cache, so only
+    images without a cached analysis are sent.
+    """
+    analyses = [None] * len(images)
+    try:
+        reference_context = load_reference_context(reference_image_path, reference_text_path)
+        cache_keys = [analysis_cache_key(image, reference_context["digest"], _analysis_variant()) for image in images]
+        pending = []
+        for index, cache_key in enumerate(cache_keys):
+            analyses[index] = load_cached_analysis(cache_key)
+            if analyses[index] is None:
+                pending.append(index)
+        if not pending:
+            return analyses
+        
+        content = list(reference_context["content"])
+        content.append({"type": "text", "text": ANALYSIS_PROMPT})
+        content.append({"type": "text", "text": BATCH_ANALYSIS_PROMPT.format(count=len(pending))})
+        for index in pending:
+            content.append(_image_content_part(images[index]))
+        
+        response = get_client().create_chat_completion(
+            model=MODEL_NAME,
+            messages=[
+                {"role": "system", "content": SYSTEM_MESSAGE},
+                {"role": "user", "content": content}
+            ],
+            **_structured_output_kwargs(BATCH_ANALYSIS_SCHEMA, "sop_analysis_batch")
+        )
+        response_text = (response.choices[0].message.content or "").strip()
+        with sop_metrics.timed("parse_json"):
+            diagrams = (parse_analysis_response(response_text, "diagrams") or {}).get("diagrams")
+        if not isinstance(diagrams, list):
+            print("Error parsing batched analysis: no diagrams list in response")
+            print("Raw response:", response_text)
+            return analyses
+        
+        for index, analysis in zip(pending, diagrams):
+            if is_analysis(analysis):
+                analyses[index] = analysis
+                store_cached_analysis(cache_keys[index], analysis)
+    
+    except Exception as e:
+        print(f"Error analyzing images with OpenAI: {e}")
+        sop_metrics.log_event("error", stage="analyze_batched", error=str(e))
+    
+    return analyses
+
+def analyze_process_flow_images(images, reference_image_path=None, reference_text_path=None, on_step=None):
+    """
+    Analyze every image of a PDF, returning analyses aligned with images.
+    
+    A single image takes the normal path. Several images are either grouped
+    IMAGES_PER_REQUEST at a time into batched requests, or analyzed
+    concurrently by up to MAX_DIAGRAM_WORKERS threads. Either way each
+    image is cached on its own, so only changed diagrams are re-analyzed.
+    """
+    if len(images) == 1:
+        return [analyze_process_flow_image(images[0], reference_image_path, reference_text_path, on_step=on_step)]
+    
+    if IMAGES_PER_REQUEST > 1:
+        analyses = [None] * len(images)
+        # Images analyzed in tiles need requests of their own
+        batchable = [index for index, image in enumerate(images) if not needs_tiling(image)]
+        for start in range(0, len(batchable), IMAGES_PER_REQUEST):
+            group = batchable[start:start + IMAGES_PER_REQUEST]
+            group_analyses = analyze_process_flow_images_batched(
+                [images[index] for index in group], reference_image_path, reference_text_path
+            )
+            for index, analysis in zip(group, group_analyses):
+                analyses[index] = analysis
+        for index, image in enumerate(images):
+            if index not in batchable:
+                analyses[index] = analyze_process_flow_image(image, reference_image_path, reference_text_path)
+        return analyses
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_DIAGRAM_WORKERS, len(images)))) as diagram_pool:
+        return map_in_context(
+            diagram_pool,
+            lambda image: analyze_process_flow_image(image, reference_image_path, reference_text_path),
+            images
+        )
+
+def tile_boxes(width, height, tile_size=None, overlap=None):
+    """
+    Return the (left, top, right, bottom) boxes of overlapping tiles covering
+    an image, row by row, spread evenly so no tile is a thin remainder.
+    """
+    tile_size = tile_size or TILE_SIZE
+    overlap = TILE_OVERLAP if overlap is None else overlap
+    
+    def spans(length):
+        if length <= tile_size:
+            return [(0, length)]
+        stride = tile_size * (1 - overlap)
+        count = -(-(length - tile_size) // stride) + 1
+        step = (length - tile_size) / (count - 1)
+        return [(round(index * step), round(index * step) + tile_size) for index in range(int(count))]
+    
+    return [
+        (left, top, right, bottom)
+        for top, bottom in spans(height)
+        for left, right in spans(width)
+    ]
+
+def _step_text(step):
+    # Comparable text of a step: its normalized role and task names. The
+    # role is kept apart so that boxes of the same lane are compared on
+    # their tasks alone
+    tasks = " ".join(
+        str(activity.get("task", "")) for activity in step.get("activities") or [] if isinstance(activity, dict)
+    )
+    return " ".join(str(step.get("role", "")).lower().split()), " ".join(tasks.lower().split())
+
+def _merge_step_into(existing, step):
+    # Add the activities and details of a duplicate step that the kept one lacks
+    activities = {
+        " ".join(str(activity.get("task", "")).lower().split()): activity
+        for activity in existing.setdefault("activities", [])
+        if isinstance(activity, dict)
+    }
+    for activity in step.get("activities") or []:
+        if not isinstance(activity, dict):
+            continue
+        key = " ".join(str(activity.get("task", "")).lower().split())
+        if key not in activities:
+            activities[key] = dict(activity, details=list(activity.get("details") or []))
+            existing["activities"].append(activities[key])
+            continue
+        details = activities[key].setdefault("details", [])
+        for detail in activity.get("details") or []:
+            if detail not in details:
+                details.append(detail)
+
+def merge_tile_analyses(overview, tile_analyses):
+    """
+    Merge the analyses of a diagram's overview and tiles into one analysis.
+    
+    Title, Objective and purpose come from the overview (or the first tile
+    that has them), and its steps give the order. Tile steps are then
+    merged in tile order: a step with the same role as one already present
+    and tasks at least TILE_STEP_SIMILARITY similar to it (e.g. a box seen
+    in two overlapping tiles) adds only its missing activities and details;
+    any other step is inserted after the last step matched from the same
+    tile. Steps are renumbered if the merged labels are not unique.
+    """
+    import difflib
+    sources = [analysis for analysis in [overview, *tile_analyses] if analysis]
+    if not sources:
+        return None
+    
+    merged = {
+        key: next((analysis[key] for analysis in sources if analysis.get(key)), "N/A")
+        for key in ("title", "Objective", "purpose")
+    }
+    steps = []
+    texts = []
+    # Steps of one analysis are never merged with each other, and each kept
+    # step absorbs at most one step per analysis: repeated boxes stay apart
+    claimed = []
+    for source, analysis in enumerate(sources):
+        position = None
+        for step in analysis.get("steps") or []:
+            if not isinstance(step, dict):
+                continue
+            text = _step_text(step)
+            match = None
+            for index, existing_text in enumerate(texts):
+                if source in claimed[index]:
+                    continue
+                if text[0] != existing_text[0]:
+                    continue
+                if text[1] == existing_text[1] or difflib.SequenceMatcher(None, text[1], existing_text[1]).ratio() >= TILE_STEP_SIMILARITY:
+                    match = index
+                    break
+            if match is not None:
+                _merge_step_into(steps[match], step)
+                claimed[match].add(source)
+                position = match + 1
+                continue
+            position = len(steps) if position is None else position
+            steps.insert(position, json.loads(json.dumps(step)))
+            texts.insert(position, text)
+            claimed.insert(position, {source})
+            position += 1
+    
+    labels = [str(step.get("step", "")) for step in steps]
+    if len(set(labels)) != len(labels) or "" in labels:
+        for number, step in enumerate(steps, start=1):
+            step["step"] = str(number)
+    merged["steps"] = steps
+    return merged
+
+def analyze_tiled_image(image, reference_image_path=None, reference_text_path=None, use_cache=True):
+    """
+    Analyze an oversized process flow image as overlapping tiles plus a
+    low-resolution overview, concurrently, and merge the results.
+    
+    Returns None if any request failed, since a merge missing a tile would
+    silently drop part of the diagram. Tiles that succeeded stay cached, so
+    a retry only requests the failed ones.
+    """
+    from PIL import Image
+    boxes = tile_boxes(*image.size)
+    overview = image.copy()
+    overview.thumbnail((TILE_OVERVIEW_DIMENSION, TILE_OVERVIEW_DIMENSION), Image.LANCZOS)
+    columns = len({box[0] for box in boxes})
+    sop_metrics.increment("analysis_tiles_total", len(boxes))
+    print(f"Analyzing {image.size[0]}x{image.size[1]} image as {len(boxes)} tiles plus an overview")
+    
+    def analyze_tile(index):
+        if index < 0:
+            # An empty tile_prompt keeps the overview itself from being tiled
+            return analyze_process_flow_image(
+                overview, reference_image_path, reference_text_path, use_cache=use_cache, tile_prompt=""
+            )
+        row, column = divmod(index, columns)
+        tile_prompt = TILE_ANALYSIS_PROMPT.format(index=index + 1, count=len(boxes), row=row + 1, column=column + 1)
+        return analyze_process_flow_image(
+            image.crop(boxes[index]), reference_image_path, reference_text_path,
+            use_cache=use_cache, tile_prompt=tile_prompt
+        )
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_TILE_WORKERS, len(boxes) + 1))) as tile_pool:
+        results = map_in_context(tile_pool, analyze_tile, range(-1, len(boxes)))
+    
+    failed = sum(result is None for result in results)
+    if failed:
+        print(f"{failed} of {len(results)} tile analyses failed")
+        return None
+    return merge_tile_analyses(results[0], results[1:])
+
+def iter_image_candidates(pdf_document, min_area=None):
+    """
+    Lazily yield metadata for embedded images, page by page, without decoding them.
+    
+    Each candidate is a dict with the page number, xref, pixel size and a
+    cheap score (pixel area, reduced for images placed in the page header
+    or footer band where logos and signatures usually sit). Images reused
+    on several pages are only yielded once.
+    """
+    min_area = MIN_IMAGE_AREA if min_area is None else min_area
+    seen_xrefs = set()
+    for page_num in range(len(pdf_document)):
+        page = pdf_document[page_num]
+        page_height = page.rect.height or 1
+        
+        for img_info in page.get_images(full=True):
+            xref, width, height = img_info[0], img_info[2], img_info[3]
+            if xref in seen_xrefs:
+                continue
+            seen_xrefs.add(xref)
+            
+            area = width * height
+            if area < min_area:
+                continue
+            
+            score = float(area)
+            try:
+                rects = page.get_image_rects(xref)
+            except Exception:
+                rects = []
+            if rects:
+                rect = rects[0]
+                band = page_height * HEADER_FOOTER_BAND
+                if rect.y1 <= page.rect.y0 + band or rect.y0 >= page.rect.y1 - band:
+                    score *= 0.25
+            
+            yield {
+                "page": page_num,
+                "xref": xref,
+                "width": width,
+                "height": height,
+                "score": score,
+            }
+
+def decode_image_candidate(pdf_document, candidate):
+    """
+    Decode a candidate yielded by iter_image_candidates into a PIL Image.
+    """
+    from PIL import Image
+    base_image = pdf_document.extract_image(candidate["xref"])
+    return Image.open(io.BytesIO(base_image["image"]))
+
+def render_vector_flowchart(pdf_document, min_drawings=None, dpi=None):
+    """
+    Render the page with the most vector drawing operations as an image.
+    
+    Used when a flowchart is drawn with PDF vector graphics instead of
+    being embedded as a picture. Returns None if no page has enough drawings.
+    """
+    from PIL import Image
+    min_drawings = MIN_VECTOR_DRAWINGS if min_drawings is None else min_drawings
+    best_page, best_count = None, 0
+    for page_num in range(len(pdf_document)):
+        count = len(pdf_document[page_num].get_drawings())
+        if count > best_count:
+            best_page, best_count = page_num, count
+    
+    if best_page is None or best_count < min_drawings:
+        return None
+    
+    pixmap = pdf_document[best_page].get_pixmap(dpi=dpi or PAGE_RENDER_DPI)
+    return Image.open(io.BytesIO(pixmap.tobytes("png")))
+
+def iter_images_from_pdf(pdf_document, render_fallback=True):
+    """
+    Yield decoded images from an open PDF, best candidates first.
+    
+    Ranking only needs image metadata, so images are decoded one at a time
+    as the caller asks for them; stopping after the first image decodes
+    nothing else. If the PDF has no usable embedded image, the page with
+    the most vector drawings is rendered instead (unless render_fallback
+    is false).
+    """
+    candidates = sorted(
+        iter_image_candidates(pdf_document),
+        key=lambda candidate: (-candidate["score"], candidate["page"])
+    )
+    
+    found = False
+    for candidate in candidates:
+        try:
+            yield decode_image_candidate(pdf_document, candidate)
+            found = True
+        except Exception as img_error:
+            print(f"Error extracting image {candidate['xref']} from page {candidate['page']}: {img_error}")
+    
+    if not found and render_fallback:
+        rendered = render_vector_flowchart(pdf_document)
+        if rendered is not None:
+            yield rendered
+
+def open_pdf(pdf_source):
+    """
+    Open a PDF from a file path or from in-memory bytes.
+    """
+    import fitz  # PyMuPDF
+    if isinstance(pdf_source, (bytes, bytearray, memoryview)):
+        return fitz.open(stream=pdf_source, filetype="pdf")
+    return fitz.open(pdf_source)
+
+class LowConfidenceError(ValueError):
+    """
+    Raised when no image in a PDF looks enough like a process flow diagram.
+    """
+
+def _count_line_segments(mask, min_length, max_length):
+    # Runs of set pixels per row of a mode "L" mask that are neither too short nor too long
+    pattern = re.compile(rb"\xff{%d,%d}(?!\xff)" % (min_length, max_length))
+    data = mask.tobytes()
+    width, height = mask.size
+    return sum(len(pattern.findall(data, row * width, (row + 1) * width)) for row in range(height))
+
+def _thin_strokes(mask, dx, dy):
+    # Keep only pixels whose neighbours dx/dy away on both sides are unset,
+    # i.e. thin lines across that direction rather than filled areas
+    from PIL import ImageChops
+    shifted = ImageChops.lighter(ImageChops.offset(mask, dx, dy), ImageChops.offset(mask, -dx, -dy))
+    return ImageChops.subtract(mask, shifted)
+
+def _background_level(gray):
+    # The most common grey level: the page of a diagram, whether white,
+    # tinted or a scan's light grey
+    histogram = gray.histogram()
+    return histogram.index(max(histogram))
+
+def _line_mask(image, background):
+    # Outlines of everything that stands out from the background: pixels
+    # differing from it by more than CLASSIFIER_INK_CONTRAST (so antialiased
+    # thin lines count, and filled boxes as well as outlined ones), reduced
+    # to CLASSIFIER_LINE_SIZE by marking each output pixel whose box holds
+    # a few such source pixels, minus the interior of filled areas. Box-
+    # averaging the greyscale image instead would fade thin lines by a
+    # size-dependent amount and make the line count unstable across sizes.
+    from PIL import Image, ImageChops, ImageFilter
+    gray = image.convert("L")
+    ink = ImageChops.difference(gray, Image.new("L", gray.size, background)).point(
+        lambda value: 255 if value > CLASSIFIER_INK_CONTRAST else 0
+    )
+    width, height = ink.size
+    scale = CLASSIFIER_LINE_SIZE / max(width, height)
+    if scale < 1:
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        ink = ink.resize(size, Image.BOX).point(lambda value: 255 if value >= 16 else 0)
+    # Eroding removes thin lines entirely and shrinks filled areas by a
+    # pixel, so the difference keeps lines and the edges of filled boxes
+    return ImageChops.subtract(ink, ink.filter(ImageFilter.MinFilter(3)))
+
+def flowchart_features(image):
+    """
+    Measure the cues that separate process flow diagrams from logos,
+    signatures, photos and pages of text.
+    
+    Returns a dict with the image's pixel size, its background grey level,
+    the fraction of light (background) pixels, the fraction of edge pixels
+    and the number of distinct colours on a CLASSIFIER_SIZE thumbnail, and
+    the number of thin horizontal and vertical line segments of box-edge
+    length (shorter than most of the image, so page borders and table rules
+    spanning it are not counted) at CLASSIFIER_LINE_SIZE. Lines are found
+    relative to the background, and filled boxes count by their edges.
+    """
+    from PIL import Image, ImageFilter
+    width, height = image.size
+    thumbnail = image.convert("RGB")
+    thumbnail.thumbnail((CLASSIFIER_SIZE, CLASSIFIER_SIZE), Image.BOX)
+    gray = thumbnail.convert("L")
+    pixels = gray.size[0] * gray.size[1]
+    
+    edges = gray.filter(ImageFilter.FIND_EDGES)
+    colors = thumbnail.getcolors(4096)
+    background = _background_level(gray)
+    # Light means near-white, or for a grey scan near its background
+    light_level = max(150, min(200, background - 25))
+    mask = _line_mask(image, background)
+    mask_width, mask_height = mask.size
+    vertical = _thin_strokes(mask, 3, 0).transpose(Image.TRANSPOSE)
+    return {
+        "width": width,
+        "height": height,
+        "background": background,
+        "light": sum(gray.histogram()[light_level:]) / pixels,
+        "edges": sum(edges.histogram()[64:]) / pixels,
+        "colors": len(colors) if colors else 4097,
+        "horizontal_lines": _count_line_segments(
+            _thin_strokes(mask, 0, 3), max(5, mask_width // 32), int(mask_width * 0.8)
+        ),
+        "vertical_lines": _count_line_segments(vertical, max(5, mask_height // 32), int(mask_height * 0.8)),
+    }
+
+def flowchart_score(image):
+    """
+    Score how likely an image is a process flow diagram, from 0 to 1.
+    
+    Diagrams are reasonably large, not extremely wide or tall, mostly light
+    background with line art in few colours, and have both horizontal and
+    vertical box edges; the score needs all of these to be high.
+    """
+    features = flowchart_features(image)
+    width, height = features["width"], features["height"]
+    size = min(1.0, (width * height) ** 0.5 / 600)
+    ratio = max(width, height) / max(1, min(width, height))
+    aspect = 1.0 if ratio <= 3 else max(0.0, 1 - (ratio - 3) / 3)
+    background = min(1.0, max(0.0, (features["light"] - 0.4) / 0.4))
+    edges = 1.0 if 0.01 <= features["edges"] <= 0.3 else 0.3
+    colors = 1.0 if features["colors"] <= 2048 else 0.5 if features["colors"] <= 4096 else 0.1
+    structure = min(1.0, min(features["horizontal_lines"], features["vertical_lines"]) / 6)
+    return size * aspect * (0.4 * background + 0.3 * edges + 0.3 * colors) * (0.3 + 0.7 * structure)
+
+def extract_scored_images(pdf_source, max_candidates=None):
+    """
+    Decode the best ranked images of a PDF and score them with flowchart_score.
+    
+    Returns (score, image) pairs, best score first. If no embedded image
+    reaches FLOWCHART_MIN_SCORE, the page with the most vector drawings
+    is rendered and scored too.
+    """
+    max_candidates = max_candidates or CLASSIFY_MAX_CANDIDATES
+    scored = []
+    try:
+        pdf_document = open_pdf(pdf_source)
+        
+        # Only the first max_candidates images are decoded
+        for image in itertools.islice(iter_images_from_pdf(pdf_document, render_fallback=False), max_candidates):
+            image.load()
+            scored.append((flowchart_score(image), image))
+        
+        if not scored or max(score for score, _ in scored) < FLOWCHART_MIN_SCORE:
+            rendered = render_vector_flowchart(pdf_document)
+            if rendered is not None:
+                scored.append((flowchart_score(rendered), rendered))
+        
+        pdf_document.close()
+    
+    except Exception as e:
+        print(f"Error processing PDF: {e}")
+    
+    # Stable sort: equal scores keep the size ranking
+    scored.sort(key=lambda pair: -pair[0])
+    return scored
+
+def image_stream_for_doc(image):
+    """
+    Encode a PIL Image as an in-memory PNG stream for document insertion.
+    """
+    image_stream = io.BytesIO()
+    image.save(image_stream, format="PNG")
+    image_stream.seek(0)
+    return image_stream
+
+def add_table_borders(table):
+    from docx.oxml import parse_xml
+    tbl = table._element
+    tbl_pr = tbl.xpath(".//w:tblPr")[0]
+    tbl_borders = parse_xml(
+        """
+        <w:tblBorders xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">
+            <w:top w:val="single" w:sz="4" w:space="0" w:color="000000"/>
+            <w:left w:val="single" w:sz="4" w:space="0" w:color="000000"/>
+            <w:bottom w:val="single" w:sz="4" w:space="0" w:color="000000"/>
+            <w:right w:val="single" w:sz="4" w:space="0" w:color="000000"/>
+            <w:insideH w:val="single" w:sz="4" w:space="0" w:color="000000"/>
+            <w:insideV w:val="single" w:sz="4" w:space="0" w:color="000000"/>
+        </w:tblBorders>
+        """
+    )
+    tbl_pr.append(tbl_borders)
+
+def _build_docx_skeleton(has_title):
+    """
+    Build the static SOP document with empty placeholder paragraphs where the
+    dynamic sections go. Returns the document and a dict of placeholders.
+    """
+    from docx import Document
+    from docx.shared import Pt, RGBColor
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    from docx.enum.style import WD_STYLE_TYPE
+    from docx.enum.section import WD_SECTION
+    doc = Document()
+    placeholders = {}
+    
+    # Define styles
+    title_style = doc.styles.add_style('CustomTitle', WD_STYLE_TYPE.PARAGRAPH)
+    title_font = title_style.font
+    title_font.size = Pt(26)
+    title_font.bold = True
+    title_font.color.rgb = RGBColor(16,129,242)
+
+    title_style = doc.styles.add_style('Custom', WD_STYLE_TYPE.PARAGRAPH)
+    title_font = title_style.font
+    title_font.size = Pt(20)
+    title_font.bold = True
+    title_font.color.rgb = RGBColor(0,0,0)
+    
+    heading1_style = doc.styles.add_style('CustomHeading1', WD_STYLE_TYPE.PARAGRAPH)
+    heading1_font = heading1_style.font
+    heading1_font.size = Pt(14)
+    heading1_font.bold = True
+    heading1_font.color.rgb=RGBColor(0,0,0)
+    
+    heading2_style = doc.styles.add_style('CustomHeading2', WD_STYLE_TYPE.PARAGRAPH)
+    heading2_font = heading2_style.font
+    heading2_font.size = Pt(12)
+    heading2_font.bold = True
+    heading2_font.color.rgb = RGBColor(0,0,0)
+
+    # Add title
+    if has_title:
+        doc.add_paragraph()
+        doc.add_paragraph()
+        doc.add_paragraph()
+        doc.add_paragraph()
+        doc.add_paragraph()
+        doc.add_paragraph()
+        doc.add_paragraph()
+        doc.add_paragraph()
+        doc.add_paragraph()
+        title_para = doc.add_paragraph()
+        title_para.style = 'CustomTitle'
+        title_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        placeholders['title'] = title_para
+        title_para = doc.add_paragraph("Standard Operating Procedure")
+        title_para.style = 'Custom'
+        title_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        doc.add_paragraph()
+        section = doc.add_section(WD_SECTION.NEW_PAGE)
+
+    doc.add_paragraph("Document History", style='CustomHeading1')
+    doc.add_paragraph('Document Location', style='CustomHeading2')
+    doc.add_paragraph('This is an on-line document. Paper copies are valid only on the day they are printed. Refer to the Genpact approver for location where last version of the document is stored or if you are in any doubt about the accuracy of this document')
+    # Add Process Flow Map heading
+    doc.add_paragraph('Document Creation', style='CustomHeading2')
+    table = doc.add_table(rows=2, cols=3)
+    add_table_borders(table)  # Add borders to the table
+    hdr_cells = table.rows[0].cells
+    hdr_cells[0].text = 'Creation Date'
+    hdr_cells[1].text = 'Genpact approval by'
+    hdr_cells[2].text = 'Customer approval by'
+
+    doc.add_paragraph('Revision History', style='CustomHeading2')
+    table = doc.add_table(rows=4, cols=5)
+    add_table_borders(table)  # Add borders to the table
+    hdr_cells = table.rows[0].cells
+    hdr_cells[0].text = 'Revision Date'
+    hdr_cells[1].text = 'Version Number'
+    hdr_cells[2].text = 'Change Reason'
+    hdr_cells[3].text = 'Pages Changed'
+    hdr_cells[4].text = 'Approval By'
+    section = doc.add_section(WD_SECTION.NEW_PAGE)
+
+    doc.add_paragraph('Table of Contents', style='CustomHeading1')
+    toc_items = [
+        ' Overview',
+        '   Purpose and Scope',
+        '   Definitions',
+        '   System of Engagement',
+        '   Roles and Responsibilities',
+        ' Process Narrative',
+        '   COPIS',
+        '   Process Map/Flowchart',
+        ' Detailed Process Steps',
+        ' Process Exceptions Handling',
+        ' Compliance Control',
+        ' Escalation Process',
+        ' Process SLAs',
+        ' Related Documents',
+        ' Sign Off'
+    ]
+    for item in toc_items:
+        doc.add_paragraph(item, style='List Number')
+    section = doc.add_section(WD_SECTION.NEW_PAGE)
+
+    doc.add_paragraph('Overview', style='CustomHeading1')
+    doc.add_paragraph('     Purpose and Scope', style='CustomHeading2')
+    placeholders['Objective'] = doc.add_paragraph()
+    doc.add_paragraph('     Definitions', style='CustomHeading2')
+    doc.add_paragraph('         Acronyms', style='CustomHeading2')
+    table = doc.add_table(rows=4, cols=2)
+    add_table_borders(table)  # Add borders to the table
+    hdr_cells = table.rows[0].cells
+    hdr_cells[0].text = 'Abbreviation:'
+    hdr_cells[1].text = 'Long Form:'
+    doc.add_paragraph('         Definitions', style='CustomHeading2')
+    table = doc.add_table(rows=4, cols=2)
+    add_table_borders(table)  # Add borders to the table
+    hdr_cells = table.rows[0].cells
+    hdr_cells[0].text = 'Term:'
+    hdr_cells[1].text = 'Definition:'
+    section = doc.add_section(WD_SECTION.NEW_PAGE)
+
+    doc.add_paragraph("System of Engagement", style='CustomHeading1')
+    doc.add_paragraph()
+    doc.add_paragraph()
+    doc.add_paragraph('Roles and Responsibilities in performing this activity', style='CustomHeading1')
+    table = doc.add_table(rows=4, cols=2)
+    add_table_borders(table)  # Add borders to the table
+    hdr_cells = table.rows[0].cells
+    hdr_cells[0].text = 'Role:'
+    hdr_cells[1].text = 'Responsibility:'
+    section = doc.add_section(WD_SECTION.NEW_PAGE)
+
+    doc.add_paragraph("Process Narrative", style='CustomHeading1') 
+    placeholders['purpose'] = doc.add_paragraph()
+    doc.add_paragraph("Process Flow Map", style='CustomHeading1')
+    doc.add_paragraph()
+
+    # The process flow image is inserted into this paragraph
+    placeholders['image'] = doc.add_paragraph()
+    
+    # Add spacing after image
+    section = doc.add_section(WD_SECTION.NEW_PAGE)
+
+    doc.add_paragraph("Detailed Process Steps", style='CustomHeading1') 
+    # Steps are inserted before this marker, which is removed afterwards
+    placeholders['steps'] = doc.add_paragraph()
+    
+    doc.add_paragraph()
+    doc.add_paragraph("Process Exception Handling", style='CustomHeading1') 
+    doc.add_paragraph()
+    doc.add_paragraph("Compliance control", style='CustomHeading1') 
+    doc.add_paragraph()
+    doc.add_paragraph("Escalation Process", style='CustomHeading1') 
+    table = doc.add_table(rows=3, cols=4)
+    add_table_borders(table)  # Add borders to the table
+    hdr_cells = table.rows[0].cells
+    hdr_cells[0].text = 'Escalation Level:'
+    hdr_cells[1].text = 'Name of Contact'
+    hdr_cells[2].text = 'Title'
+    hdr_cells[3].text = 'Email'
+    doc.add_paragraph("Process SLAs", style='CustomHeading1')
+    table = doc.add_table(rows=4, cols=5)
+    add_table_borders(table)  # Add borders to the table
+    hdr_cells = table.rows[0].cells
+    hdr_cells[0].text = 'Indicator:'
+    hdr_cells[1].text = 'Name'
+    hdr_cells[2].text = 'Operational Definition'
+    hdr_cells[3].text = 'Target'
+    hdr_cells[4].text = 'Minimum Level'
+    doc.add_paragraph("Related Documents", style='CustomHeading1')
+    doc.add_paragraph() 
+    doc.add_paragraph("Sign Off", style='CustomHeading1') 
+
+    return doc, placeholders
+
+def _docx_template(has_title):
+    """
+    Return the cached (template_bytes, placeholder_positions) for a skeleton.
+    
+    Placeholder positions are indexes into the document body, so a fresh
+    copy loaded from the bytes can find its placeholders without searching.
+    """
+    with _docx_template_lock:
+        if has_title not in _docx_templates:
+            doc, placeholders = _build_docx_skeleton(has_title)
+            body = list(doc.element.body)
+            positions = {name: body.index(para._p) for name, para in placeholders.items()}
+            template_stream = io.BytesIO()
+            doc.save(template_stream)
+            _docx_templates[has_title] = (template_stream.getvalue(), positions)
+        return _docx_templates[has_title]
+
+def _load_docx_skeleton(has_title):
+    from docx import Document
+    from docx.text.paragraph import Paragraph
+    template_bytes, positions = _docx_template(has_title)
+    doc = Document(io.BytesIO(template_bytes))
+    body = list(doc.element.body)
+    placeholders = {name: Paragraph(body[index], doc._body) for name, index in positions.items()}
+    return doc, placeholders
+
+def _add_text(paragraph, text):
+    # Mirrors doc.add_paragraph(text), which only adds a run for non-empty text
+    if text:
+        paragraph.add_run(text)
+
+def create_docx_from_analysis(analysis_json, output_path, process_flow_image, use_template=True):
+    """
+    Create a DOCX file from the analysis JSON with proper formatting.
+    output_path may be a file path or a file-like object.
+    
+    The static parts of the document are built once per process and cached
+    as a template; only the title, Objective, purpose, image and steps are
+    filled in per document. use_template=False builds the skeleton from scratch.
+    """
+    from docx.shared import Inches
+    has_title = 'title' in analysis_json
+    if use_template:
+        doc, placeholders = _load_docx_skeleton(has_title)
+    else:
+        doc, placeholders = _build_docx_skeleton(has_title)
+    
+    if has_title:
+        _add_text(placeholders['title'], analysis_json['title'])
+    _add_text(placeholders['Objective'], analysis_json.get('Objective', 'N/A'))
+    _add_text(placeholders['purpose'], analysis_json.get('purpose', 'N/A'))
+    
+    # Insert the process flow image(s) with specified width, keeping the picture
+    # name the file-based insertion used to record
+    images = process_flow_image if isinstance(process_flow_image, list) else [process_flow_image]
+    for image_index, image in enumerate(images):
+        run = placeholders['image'].add_run()
+        if image_index:
+            run.add_break()
+        picture = run.add_picture(image_stream_for_doc(image), width=Inches(6.0))
+        picture._inline.graphic.graphicData.pic.nvPicPr.cNvPr.name = 'process_flow_map.png'
+    
+    # Resolve style ids once; python-docx otherwise scans every style on each lookup
+    heading1_style_id = doc.styles['CustomHeading1'].style_id
+    heading2_style_id = doc.styles['CustomHeading2'].style_id
+    bullet_style_id = doc.styles['List Bullet'].style_id
+    
+    def insert_step_paragraph(text="", style_id=None):
+        paragraph = steps_marker.insert_paragraph_before(text)
+        if style_id:
+            paragraph._p.style = style_id
+        return paragraph
+    
+    def insert_steps(steps):
+        if isinstance(steps, str):
+            insert_step_paragraph(steps)
+        elif isinstance(steps, list):
+            for item in steps:
+                step_heading = f"Step {item.get('step', 'N/A')}: {item.get('role', 'N/A')}"
+                insert_step_paragraph(step_heading, heading2_style_id)
+                
+                if 'activities' in item and isinstance(item['activities'], list):
+                    for activity in item['activities']:
+                        task_para = insert_step_paragraph()
+                        task_para.add_run(f"Task: {activity.get('task', 'N/A')}").bold = True
+                        
+                        if 'details' in activity and isinstance(activity['details'], list):
+                            for detail in activity['details']:
+                                insert_step_paragraph(f"{detail}", bullet_style_id)
+                        insert_step_paragraph()
+    
+    # Process other top-level keys
+    steps_marker = placeholders['steps']
+    if 'sections' in analysis_json:
+        # Merged multi-diagram SOP: one titled section per process flow
+        for section_index, section in enumerate(analysis_json['sections'], start=1):
+            insert_step_paragraph(f"{section_index}. {section.get('title', 'Process Flow')}", heading1_style_id)
+            insert_steps(section.get('steps', []))
+    elif 'steps' in analysis_json:
+        insert_steps(analysis_json['steps'])
+    steps_marker._p.getparent().remove(steps_marker._p)
+
+    # Save the document (output_path may be a path or a writable stream)
+    doc.save(output_path)
+
+def select_flowchart_images(pdf_data, flag_low_confidence=True):
+    """
+    Return (images, warning) with the process flow images to analyze for a PDF.
+    
+    Only images scoring at least FLOWCHART_MIN_SCORE are returned, best
+    first: with SOP_MULTI_FLOWCHART_MODE off just the best one, otherwise
+    up to MAX_FLOWCHARTS_PER_PDF. If the PDF has images but none qualifies
+    and flag_low_confidence is true (it is false when the analysis is
+    supplied), LOW_CONFIDENCE_POLICY "flag" raises LowConfidenceError and
+    "send" returns the best scoring image with a warning; warning is None
+    otherwise.
+    """
+    max_images = 1 if MULTI_FLOWCHART_MODE == "off" else MAX_FLOWCHARTS_PER_PDF
+    scored = extract_scored_images(pdf_data, max_candidates=max(max_images, CLASSIFY_MAX_CANDIDATES))
+    if not scored:
+        return [], None
+    
+    images = [image for score, image in scored if score >= FLOWCHART_MIN_SCORE]
+    if images:
+        return images[:max_images], None
+    
+    message = (
+        f"No image looks like a process flow diagram (best score {scored[0][0]:.2f}, "
+        f"threshold {FLOWCHART_MIN_SCORE:.2f})"
+    )
+    if not flag_low_confidence:
+        return [scored[0][1]], None
+    if LOW_CONFIDENCE_POLICY == "flag":
+        raise LowConfidenceError(message)
+    return [scored[0][1]], f"{message}; analyzed the best candidate anyway"
+
+def extract_flowchart_images(pdf_data, flag_low_confidence=True):
+    """
+    Return the process flow images to analyze for a PDF (see select_flowchart_images).
+    """
+    return select_flowchart_images(pdf_data, flag_low_confidence)[0]
+
+def render_docx_bytes(analysis_json, image):
+    """
+    Render the SOP document for an analysis and return the DOCX bytes.
+    """
+    output = io.BytesIO()
+    create_docx_from_analysis(analysis_json, output, image)
+    return output.getvalue()
+
+def _load_analysis(analysis):
+    if isinstance(analysis, str):
+        return json.loads(analysis)
+    return analysis
+
+def merge_analyses(analyses):
+    """
+    Combine the analyses of several diagrams into one SOP with ordered sections.
+    """
+    merged = {}
+    if 'title' in analyses[0]:
+        merged['title'] = analyses[0]['title']
+    for key in ('Objective', 'purpose'):
+        texts = []
+        for analysis in analyses:
+            text = analysis.get(key)
+            if text and text not in texts:
+                texts.append(text)
+        merged[key] = "\n\n".join(texts) if texts else 'N/A'
+    merged['sections'] = [
+        {
+            'title': analysis.get('title') or f"Process Flow {index}",
+            'steps': analysis.get('steps', [])
+        }
+        for index, analysis in enumerate(analyses, start=1)
+    ]
+    return merged
+
+def load_analysis_json(text):
+    """
+    Parse an edited or uploaded analysis JSON into a list of analyses, one per diagram.
+    
+    Accepts a single analysis object, a list of them or the batched
+    {"diagrams": [...]} form; every analysis must be an object with a
+    "steps" list. Raises ValueError otherwise.
+    """
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON: {e}")
+    if isinstance(data, dict) and isinstance(data.get("diagrams"), list):
+        data = data["diagrams"]
+    analyses = data if isinstance(data, list) else [data]
+    if not analyses:
+        raise ValueError("The analysis JSON contains no diagrams")
+    for analysis in analyses:
+        if not is_analysis(analysis):
+            raise ValueError('Each analysis must be an object with a "steps" list')
+    return analyses
+
+def dump_analysis_json(analyses):
+    """
+    Format analyses for editing or download (a single object for one diagram).
+    """
+    return json.dumps(analyses[0] if len(analyses) == 1 else analyses, indent=2, ensure_ascii=False)
+
+def render_from_analyses(name, pdf_data, analyses):
+    """
+    Render a PDF's DOCX output(s) from existing analyses, without calling the model.
+    
+    The PDF is only needed for the process flow image(s) embedded in the
+    document. Returns a list of (output_name, docx_bytes).
+    """
+    images = extract_flowchart_images(pdf_data, flag_low_confidence=False)
+    if not images:
+        raise ValueError("No images found in PDF")
+    return render_pdf_outputs(name, analyses, images)
+
+def render_pdf_outputs(pdf_name, analyses, images):
+    """
+    Render the DOCX output(s) for one PDF as a list of (output_name, docx_bytes).
+    
+    Diagrams whose analysis failed are skipped. In "merge" mode all
+    diagrams go into one document; in "split" mode each gets its own.
+    """
+    stem = os.path.splitext(pdf_name)[0]
+    pairs = [(_load_analysis(analysis), image) for analysis, image in zip(analyses, images) if analysis]
+    if not pairs:
+        return []
+    
+    if MULTI_FLOWCHART_MODE == "merge" and len(pairs) > 1:
+        merged = merge_analyses([analysis for analysis, _ in pairs])
+        return [(stem + ".docx", render_docx_bytes(merged, [image for _, image in pairs]))]
+    
+    if MULTI_FLOWCHART_MODE == "split" and len(pairs) > 1:
+        return [
+            (f"{stem}_diagram{index}.docx", render_docx_bytes(analysis, image))
+            for index, (analysis, image) in enumerate(pairs, start=1)
+        ]
+    
+    analysis, image = pairs[0]
+    return [(stem + ".docx", render_docx_bytes(analysis, image))]
+
+def process_pdf_outputs(pdf_data, name="document.pdf", reference_set=None, on_step=None):
+    """
+    Process a single PDF and return its outputs as a list of (output_name, docx_bytes).
+    """
+    with sop_metrics.timed("extract", document=name):
+        images, warning = select_flowchart_images(pdf_data)
+    if not images:
+        return []
+    if warning:
+        print(f"{name}: {warning}")
+    
+    reference_image_path, reference_text_path = get_reference_paths(reference_set)
+    with sop_metrics.timed("analyze", document=name):
+        analyses = analyze_process_flow_images(images, reference_image_path, reference_text_path, on_step=on_step)
+    with sop_metrics.timed("render", document=name):
+        return render_pdf_outputs(name, analyses, images)
+
+def process_single_pdf(pdf_data, reference_set=None):
+    """
+    Process a single PDF file and return the generated DOCX bytes
+    (the first document when SOP_MULTI_FLOWCHART_MODE is "split").
+    """
+    outputs = process_pdf_outputs(pdf_data, reference_set=reference_set)
+    if outputs:
+        return outputs[0][1]
+    
+    return None
+
+def result_store_key(pdf_source, reference_set=None, analyses=None):
+    """
+    Key of a PDF's results in the result store: its content hash plus every
+    setting that changes the analysis or the generated documents, and the
+    supplied analyses, if any.
+    """
+    reference_context = load_reference_context(*get_reference_paths(reference_set))
+    payload = {
+        "pdf": pdf_sha256(pdf_source),
+        "settings": _batch_settings(reference_set),
+        "reference": reference_context["digest"],
+        "variant": _analysis_variant(),
+        "classifier": [CLASSIFY_MAX_CANDIDATES, FLOWCHART_MIN_SCORE, LOW_CONFIDENCE_POLICY],
+        "analyses": analyses,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _process_pdf_in_pool(name, pdf_data, cpu_pool, reference_set=None, on_stage=None, on_step=None,
+                         analyses=None, on_analyses=None):
+    """
+    Run one PDF through the pipeline, using the process pool for the CPU-bound
+    stages and the calling (API worker) thread for the vision call.
+    
+    Results are shared through the result store: a PDF already processed
+    with the same settings is served from it, and one being processed by
+    another thread is waited for ("waiting" stage) instead of processed twice.
+    
+    Given analyses (e.g. an edited analysis JSON), the model is not called
+    and the document is only rendered from them.
+    
+    on_stage, if given, is called with each stage name as it starts
+    ("extracting", "analyzing", "rendering") and with "done", "failed" or
+    "flagged" (no image passed the flowchart classifier) and the error
+    message, if any, at the end. A document is done with an error when it
+    was analyzed despite a low-confidence warning or some of its diagrams
+    could not be analyzed. on_step receives each analysed step as
+    it streams in (or all at once for a stored result), and on_analyses the
+    final list of analyses.
+    """
+    on_stage = on_stage or (lambda stage, error=None: None)
+    stem = os.path.splitext(name)[0]
+    
+    def compute():
+        on_stage("extracting")
+        # Timed here rather than in the worker process, whose metrics are not collected
+        with sop_metrics.timed("extract", document=name):
+            images, warning = cpu_pool.submit(select_flowchart_images, pdf_data, analyses is None).result()
+        if not images:
+            raise ValueError("No images found in PDF")
+        if warning:
+            print(f"{name}: {warning}")
+            sop_metrics.increment("documents_low_confidence_total")
+            sop_metrics.log_event("low_confidence", document=name, warning=warning)
+        
+        document_analyses = analyses
+        if document_analyses is None:
+            on_stage("analyzing")
+            reference_image_path, reference_text_path = get_reference_paths(reference_set)
+            with sop_metrics.timed("analyze", document=name):
+                document_analyses = analyze_process_flow_images(
+                    images,
+                    reference_image_path=reference_image_path,
+                    reference_text_path=reference_text_path,
+                    on_step=on_step
+                )
+            if not any(document_analyses):
+                raise ValueError("Analysis of the process flow image failed")
+        failed = sum(analysis is None for analysis in document_analyses)
+        # Diagrams that failed are left out of the document; the result is
+        # then not stored, so the next request analyzes them again
+        incomplete = f"{failed} of {len(document_analyses)} diagrams could not be analyzed" if failed else None
+        if incomplete:
+            print(f"{name}: {incomplete}")
+        
+        # Render as soon as the JSON is complete
+        on_stage("rendering")
+        with sop_metrics.timed("render", document=name):
+            outputs = cpu_pool.submit(render_pdf_outputs, name, document_analyses, images).result()
+        # Output names are stored without the PDF's stem, so another upload
+        # of the same content under a different name gets its own names
+        return {
+            "analyses": [_load_analysis(analysis) for analysis in document_analyses],
+            "outputs": [(output_name[len(stem):], output_data) for output_name, output_data in outputs],
+            "warning": warning,
+            "incomplete": incomplete,
+        }
+    
+    try:
+        result, source = get_result_store().get_or_compute(
+            result_store_key(pdf_data, reference_set, analyses),
+            compute,
+            on_wait=lambda: on_stage("waiting")
+        )
+        sop_metrics.increment("result_store_lookups_total", result=source)
+        if source != "computed" and on_step is not None:
+            for analysis in result["analyses"]:
+                if analysis and isinstance(analysis.get("steps"), list):
+                    for step in analysis["steps"]:
+                        on_step(step)
+        outputs = [(stem + suffix, output_data) for suffix, output_data in result["outputs"]]
+        if on_analyses is not None:
+            on_analyses(result["analyses"])
+    except Exception as e:
+        # Documents without a convincing diagram were never sent and need a human look
+        status = "flagged" if isinstance(e, LowConfidenceError) else "failed"
+        on_stage(status, str(e))
+        sop_metrics.increment("documents_total", status=status)
+        sop_metrics.log_event("document", document=name, status=status, error=str(e))
+        raise
+    
+    # Low-confidence documents analyzed anyway and documents missing some
+    # diagrams are done, with the warning and dropped diagrams as their note
+    note = "; ".join(message for message in (result.get("warning"), result.get("incomplete")) if message)
+    on_stage("done", note or None)
+    sop_metrics.increment("documents_total", status="done")
+    sop_metrics.log_event("document", document=name, status="done", outputs=len(outputs), source=source)
+    return outputs
+
+def cpu_pool_context():
+    """
+    Return the multiprocessing context for the CPU worker pool.
+    """
+    import multiprocessing
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    # Workers forked from the server then start with the pipeline imported
+    context.set_forkserver_preload([__name__])
+    return context
+
+def iter_pdf_batch(pdf_items, max_workers=None, cpu_workers=None, reference_set=None, progress=None, step_progress=None,
+                   analyses_progress=None):
+    """
+    Process (name, pdf) pairs concurrently, where pdf is the PDF's bytes or
+    a path to it (paths keep the PDFs out of memory and are cheaper to
+    send to the worker processes). An item may also be a (name, pdf,
+    analyses) triple, whose document is rendered from the given analyses
+    without calling the model.
+    
+    Yields (name, outputs, error) tuples in the same order as the input,
+    each as soon as it and all earlier items have finished. outputs is a
+    list of (output_name, docx_bytes); exactly one of outputs and error is None.
+    
+    progress, if given, is called from worker threads as
+    progress(index, stage, error) whenever a document changes stage,
+    step_progress as step_progress(index, step) for each streamed step and
+    analyses_progress as analyses_progress(index, analyses) once a
+    document's analyses are known.
+    """
+    pdf_items = list(pdf_items)
+    if not pdf_items:
+        return
+    
+    max_workers = max(1, max_workers or MAX_API_WORKERS)
+    cpu_workers = max(1, cpu_workers or MAX_CPU_WORKERS)
+    # max_workers bounds the batch's API requests, including those a
+    # document makes from its own diagram and tile threads
+    api_slots = threading.BoundedSemaphore(max_workers)
+    
+    def submit(api_pool, *args):
+        context = contextvars.copy_context()
+        context.run(_api_slots.set, api_slots)
+        return api_pool.submit(context.run, _process_pdf_in_pool, *args)
+    
+    with ProcessPoolExecutor(max_workers=min(cpu_workers, len(pdf_items)), mp_context=cpu_pool_context()) as cpu_pool:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(pdf_items))) as api_pool:
+            futures = [
+                submit(
+                    api_pool, item[0], item[1], cpu_pool, reference_set,
+                    functools.partial(progress, index) if progress else None,
+                    functools.partial(step_progress, index) if step_progress else None,
+                    item[2] if len(item) > 2 else None,
+                    functools.partial(analyses_progress, index) if analyses_progress else None
+                )
+                for index, item in enumerate(pdf_items)
+            ]
+            # Collect in submission order so output is independent of timing
+            for (name, *_), future in zip(pdf_items, futures):
+                try:
+                    yield name, future.result(), None
+                except Exception as e:
+                    yield name, None, str(e)
+
+def process_pdf_batch(pdf_items, max_workers=None, cpu_workers=None, reference_set=None):
+    """
+    Process (name, pdf_bytes) pairs concurrently and return the ordered results.
+    """
+    return list(iter_pdf_batch(pdf_items, max_workers, cpu_workers, reference_set))
+
+def load_manifest(manifest_path):
+    """
+    Load a batch manifest, returning an empty one if it does not exist.
+    """
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"documents": {}}
+
+def save_manifest(manifest_path, manifest):
+    """
+    Atomically write a batch manifest.
+    """
+    temp_path = f"{manifest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, manifest_path)
+
+def pdf_sha256(pdf_source):
+    """
+    Hash PDF bytes, or a PDF file in chunks without reading it into memory.
+    """
+    if isinstance(pdf_source, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(pdf_source).hexdigest()
+    hasher = hashlib.sha256()
+    with open(pdf_source, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def _batch_settings(reference_set):
+    # Settings that change the generated documents; outputs made under
+    # different settings are not reused
+    return {"reference_set": reference_set, "multi_flowchart_mode": MULTI_FLOWCHART_MODE}
+
+def claim_output_name(output_name, claimed_names):
+    """
+    Return output_name, numbered (e.g. "x_2.docx") if it is already in
+    claimed_names, and add the returned name to claimed_names.
+    """
+    stem, extension = os.path.splitext(output_name)
+    copy = 1
+    while output_name in claimed_names:
+        copy += 1
+        output_name = f"{stem}_{copy}{extension}"
+    claimed_names.add(output_name)
+    return output_name
+
+def _manifest_entry_done(entry, sha256, settings, output_dir):
+    return (
+        entry is not None
+        and entry.get("status") == "done"
+        and entry.get("sha256") == sha256
+        and entry.get("settings") == settings
+        and all(os.path.exists(os.path.join(output_dir, name)) for name in entry.get("outputs", []))
+    )
+
+def iter_resumable_batch(pdf_items, output_dir, manifest_path=None, resume=True, max_workers=None,
+                         cpu_workers=None, reference_set=None, progress=None, step_progress=None):
+    """
+    Process (key, name, pdf_bytes or path) items, recording every document
+    in a manifest so an interrupted batch can be resumed.
+    
+    The manifest (output_dir/manifest.json unless given) records each
+    document's content hash, current stage, status, error, note (e.g. a
+    low-confidence warning on a done document) and output file names, and
+    is saved on every change. Outputs are written to output_dir
+    as soon as a document finishes. With resume, documents already done
+    with the same content and settings, whose outputs are still on disk,
+    are skipped; new, changed, failed and flagged ones are processed.
+    
+    Yields (key, entry, skipped) in input order, where entry is the
+    document's manifest record. progress and step_progress are called as
+    for iter_pdf_batch, with the index into pdf_items.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = manifest_path or os.path.join(output_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path) if resume else {"documents": {}}
+    documents = manifest.setdefault("documents", {})
+    manifest_lock = threading.Lock()
+    settings = _batch_settings(reference_set)
+    
+    items = []
+    pending = []
+    claimed_names = set()
+    for index, (key, name, pdf_data) in enumerate(pdf_items):
+        sha256 = pdf_sha256(pdf_data)
+        skipped = resume and _manifest_entry_done(documents.get(key), sha256, settings, output_dir)
+        if not skipped:
+            documents[key] = {
+                "name": name,
+                "sha256": sha256,
+                "settings": settings,
+                "stage": "queued",
+                "status": "pending",
+                "outputs": [],
+                "error": None,
+                "note": None,
+            }
+            pending.append((index, key, name, pdf_data))
+        else:
+            claimed_names.update(documents[key]["outputs"])
+        items.append((key, skipped))
+    save_manifest(manifest_path, manifest)
+    
+    def on_progress(pending_index, stage, error=None):
+        index, key = pending[pending_index][:2]
+        with manifest_lock:
+            documents[key]["stage"] = stage
+            if stage == "done":
+                # The message a done document finishes with is a note (a
+                # low-confidence warning or diagrams left out), not an error
+                documents[key]["note"] = error
+            save_manifest(manifest_path, manifest)
+        if progress:
+            progress(index, stage, error)
+    
+    def on_step(pending_index, step):
+        step_progress(pending[pending_index][0], step)
+    
+    results = iter_pdf_batch(
+        [(name, pdf_data) for _, _, name, pdf_data in pending],
+        max_workers=max_workers,
+        cpu_workers=cpu_workers,
+        reference_set=reference_set,
+        progress=on_progress,
+        step_progress=on_step if step_progress else None
+    )
+    for key, skipped in items:
+        if skipped:
+            yield key, dict(documents[key]), True
+            continue
+        
+        _, outputs, error = next(results)
+        output_names = []
+        for output_name, output_data in outputs or []:
+            # Documents with the same name (e.g. from different ZIP folders)
+            # must not overwrite each other's output
+            output_name = claim_output_name(output_name, claimed_names)
+            with open(os.path.join(output_dir, output_name), "wb") as f:
+                f.write(output_data)
+            output_names.append(output_name)
+        
+        with manifest_lock:
+            entry = documents[key]
+            status = "done" if not error else "flagged" if entry["stage"] == "flagged" else "failed"
+            entry.update(status=status, outputs=output_names, error=error)
+            save_manifest(manifest_path, manifest)
+            entry = dict(entry)
+        yield key, entry, False
+
+def _check_zip_limits(members):
+    if len(members) > ZIP_MAX_MEMBERS:
+        raise ValueError(f"ZIP archive has {len(members)} PDFs, more than the limit of {ZIP_MAX_MEMBERS}")
+    total_size = 0
+    for info in members:
+        if info.file_size > ZIP_MAX_MEMBER_BYTES:
+            raise ValueError(f"{info.filename} is {info.file_size} bytes uncompressed, more than the limit of {ZIP_MAX_MEMBER_BYTES}")
+        if info.file_size > 1024 * 1024 and info.file_size > ZIP_MAX_RATIO * max(info.compress_size, 1):
+            raise ValueError(f"{info.filename} is compressed {info.file_size / max(info.compress_size, 1):.0f}:1, suspected zip bomb")
+        total_size += info.file_size
+    if total_size > ZIP_MAX_TOTAL_BYTES:
+        raise ValueError(f"ZIP archive expands to {total_size} bytes, more than the limit of {ZIP_MAX_TOTAL_BYTES}")
+
+def iter_zip_members(zip_source, full_paths=False):
+    """
+    Yield (filename, stream) for every PDF in a zip archive in a stable order,
+    without extracting the archive.
+    
+    zip_source is the archive's bytes, a path or a seekable file object.
+    filename is the member's base name, or with full_paths its full path
+    inside the archive (unique, unlike base names across folders).
+    Each stream reads one member and is only valid until the next one is
+    requested. The member list is checked against the ZIP_MAX_* limits
+    before anything is yielded; zipfile itself stops reading a member at
+    its declared size.
+    """
+    if isinstance(zip_source, (bytes, bytearray, memoryview)):
+        zip_source = io.BytesIO(zip_source)
+    with zipfile.ZipFile(zip_source, 'r') as zip_ref:
+        members = [
+            info for info in zip_ref.infolist()
+            if not info.is_dir() and info.filename.lower().endswith('.pdf')
+        ]
+        _check_zip_limits(members)
+        for info in sorted(members, key=lambda info: info.filename):
+            with zip_ref.open(info) as stream:
+                yield (info.filename if full_paths else os.path.basename(info.filename)), stream
+
+def iter_zip_pdfs(zip_source, spool_dir=None, full_paths=False):
+    """
+    Yield (filename, pdf) for every PDF in a zip archive, one member at a time.
+    
+    pdf is the member's bytes, or, when spool_dir is given, the path of a
+    copy written there, so at most one read buffer is held in memory.
+    filename is as for iter_zip_members.
+    """
+    for index, (filename, stream) in enumerate(iter_zip_members(zip_source, full_paths)):
+        if spool_dir is None:
+            yield filename, stream.read()
+            continue
+        spool_path = os.path.join(spool_dir, f"{index}.pdf")
+        with open(spool_path, "wb") as f:
+            shutil.copyfileobj(stream, f, 1024 * 1024)
+        yield filename, spool_path
+
+def _unique_keys(names):
+    # Manifest keys are the file names, numbered when a name repeats
+    seen = collections.Counter()
+    for name in names:
+        seen[name] += 1
+        yield name if seen[name] == 1 else f"{name}#{seen[name]}"
+
+def batch_dir_for(names):
+    """
+    Return the directory under BATCH_DIR used for a batch of the given file names.
+    """
+    digest = hashlib.sha256("\0".join(names).encode('utf-8')).hexdigest()
+    return os.path.join(BATCH_DIR, digest[:24])
+
+@contextlib.contextmanager
+def batch_lock(batch_dir):
+    """
+    Hold an exclusive lock on a batch directory, waiting for any other
+    thread or process using it to finish.
+    
+    Batches with the same file names share a directory, so without the lock
+    two callers would write the same manifest and outputs concurrently.
+    """
+    import fcntl
+    os.makedirs(batch_dir, exist_ok=True)
+    with open(os.path.join(batch_dir, ".lock"), "a") as lock_file:
+        # flock locks belong to the open file, so threads exclude each other too
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def evict_batches():
+    """
+    Remove batch directories that have not been used for BATCH_MAX_AGE.
+    """
+    if not BATCH_DIR or not os.path.isdir(BATCH_DIR):
+        return
+    now = time.time()
+    for dirname in os.listdir(BATCH_DIR):
+        batch_dir = os.path.join(BATCH_DIR, dirname)
+        try:
+            if now - os.path.getmtime(os.path.join(batch_dir, MANIFEST_NAME)) > BATCH_MAX_AGE:
+                shutil.rmtree(batch_dir, ignore_errors=True)
+        except OSError:
+            pass
+
+def process_pdf_files(pdf_items, max_workers=None, reference_set=None, batch_dir=None, output=None):
+    """
+    Process (name, pdf_bytes or path) pairs and return a zip file containing all outputs.
+    
+    Progress is recorded in a resumable batch directory (batch_dir, or one
+    under BATCH_DIR derived from the file names), so calling this again
+    for the same batch after an interruption only processes documents
+    that are not finished yet. The directory is locked for the whole run,
+    so a concurrent batch with the same file names waits for this one,
+    and only outputs produced from this call's PDFs are archived.
+    
+    The archive is written as documents finish. If output (a writable
+    binary file object) is given it is written there and output is
+    returned; otherwise it is built in a spooled temporary file and its
+    bytes are returned.
+    """
+    pdf_items = list(pdf_items)
+    keys = list(_unique_keys(name for name, _ in pdf_items))
+    if batch_dir is None and not BATCH_DIR:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            return process_pdf_files(pdf_items, max_workers, reference_set, batch_dir=temp_dir, output=output)
+    if batch_dir is None:
+        evict_batches()
+        batch_dir = batch_dir_for(keys)
+    
+    output_dir = os.path.join(batch_dir, "outputs")
+    sha256s = {key: pdf_sha256(pdf_data) for key, (_, pdf_data) in zip(keys, pdf_items)}
+    archive = output if output is not None else tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    with batch_lock(batch_dir), zipfile.ZipFile(archive, 'w') as zipf:
+        results = iter_resumable_batch(
+            [(key, name, pdf_data) for key, (name, pdf_data) in zip(keys, pdf_items)],
+            output_dir,
+            manifest_path=os.path.join(batch_dir, MANIFEST_NAME),
+            max_workers=max_workers,
+            reference_set=reference_set
+        )
+        # Each document is copied into the zip from disk as soon as it is ready
+        for key, entry, _ in results:
+            if entry["status"] != "done":
+                print(f"Error processing {entry['name']}: {entry['error']}")
+                continue
+            if entry.get("note"):
+                print(f"{entry['name']}: {entry['note']}")
+            if entry["sha256"] != sha256s[key]:
+                print(f"Skipping outputs of {entry['name']}: produced from a different PDF")
+                continue
+            for output_name in entry["outputs"]:
+                zipf.write(os.path.join(output_dir, output_name), output_name)
+    sop_metrics.write_prometheus_file()
+    
+    if output is not None:
+        return output
+    with archive:
+        archive.seek(0)
+        return archive.read()
+
+def process_zip_file(zip_source, max_workers=None, reference_set=None, output=None):
+    """
+    Process multiple PDFs from a zip file (bytes, path or file object) and
+    return a zip file containing all outputs (see process_pdf_files).
+    
+    Members are copied to a temporary directory one at a time and handed to
+    the workers by path, so the PDFs are never all in memory at once.
+    """
+    with tempfile.TemporaryDirectory() as spool_dir:
+        pdf_items = iter_zip_pdfs(zip_source, spool_dir=spool_dir)
+        return process_pdf_files(pdf_items, max_workers=max_workers, reference_set=reference_set, output=output)
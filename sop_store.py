@@ -0,0 +1,212 @@
+"""
+Process-wide store of finished SOP results, shared by every session and
+job of a server so the same PDF is analyzed and rendered only once.
+
+Results (the analysis JSON and rendered DOCX bytes of a PDF) are keyed by
+the PDF's content hash and the settings that affect them. They are kept
+in memory up to SOP_RESULT_STORE_MAX_BYTES, least recently used first
+out, and, when SOP_RESULT_STORE_DB names a SQLite file, also on disk
+(up to SOP_RESULT_STORE_DB_MAX_BYTES) so they survive restarts. A request
+for a result that is still being produced waits for it instead of
+starting the same work again.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+import collections
+from contextlib import closing
+from concurrent.futures import Future
+
+RESULT_STORE_MAX_BYTES = int(os.getenv("SOP_RESULT_STORE_MAX_BYTES", str(128 * 1024 * 1024)))
+RESULT_STORE_DB = os.getenv("SOP_RESULT_STORE_DB", "")
+RESULT_STORE_DB_MAX_BYTES = int(os.getenv("SOP_RESULT_STORE_DB_MAX_BYTES", str(1024 * 1024 * 1024)))
+RESULT_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    analyses TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS result_outputs (
+    key TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    suffix TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (key, idx)
+);
+"""
+
+
+def result_size(result):
+    """
+    Approximate memory size of a result in bytes.
+    """
+    return len(json.dumps(result["analyses"])) + sum(len(data) for _, data in result["outputs"])
+
+
+class ResultStore:
+    """
+    Thread-safe LRU store of results with in-flight deduplication.
+
+    A result is a dict with "analyses" (a list of analysis JSON, one per
+    diagram) and "outputs" (a list of (suffix, docx_bytes), where suffix is
+    the output name without the PDF's stem, e.g. ".docx"). A result whose
+    "incomplete" entry is set (some diagrams could not be analyzed) is
+    returned to its callers but never stored.
+    """
+
+    def __init__(self, max_bytes=None, db_path=None, db_max_bytes=None):
+        self.max_bytes = RESULT_STORE_MAX_BYTES if max_bytes is None else max_bytes
+        self.db_path = RESULT_STORE_DB if db_path is None else db_path
+        self.db_max_bytes = RESULT_STORE_DB_MAX_BYTES if db_max_bytes is None else db_max_bytes
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key -> (size, result), least recently used first
+        self._bytes = 0
+        self._inflight = {}  # key -> Future of the result being produced
+
+    def _db(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.executescript(RESULT_STORE_SCHEMA)
+        return conn
+
+    def _remember(self, key, result):
+        # Caller holds self._lock
+        size = result_size(result)
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[0]
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (size, result)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (evicted_size, _) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+
+    def _load(self, key):
+        if not self.db_path:
+            return None
+        try:
+            with self._db_lock, closing(self._db()) as conn, conn:
+                row = conn.execute("SELECT analyses FROM results WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                outputs = conn.execute(
+                    "SELECT suffix, data FROM result_outputs WHERE key = ? ORDER BY idx", (key,)
+                ).fetchall()
+                conn.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+            return {"analyses": json.loads(row[0]), "outputs": [(suffix, bytes(data)) for suffix, data in outputs]}
+        except Exception as e:
+            print(f"Error reading result store: {e}")
+            return None
+
+    def _save(self, key, result):
+        if not self.db_path:
+            return
+        try:
+            with self._db_lock, closing(self._db()) as conn, conn:
+                conn.execute("DELETE FROM result_outputs WHERE key = ?", (key,))
+                conn.execute(
+                    "INSERT OR REPLACE INTO results (key, analyses, size, accessed) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(result["analyses"]), result_size(result), time.time())
+                )
+                conn.executemany(
+                    "INSERT INTO result_outputs (key, idx, suffix, data) VALUES (?, ?, ?, ?)",
+                    [(key, index, suffix, data) for index, (suffix, data) in enumerate(result["outputs"])]
+                )
+                # Remove the least recently used results while over the size limit
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+                for old_key, size in conn.execute("SELECT key, size FROM results ORDER BY accessed").fetchall():
+                    if total <= self.db_max_bytes:
+                        break
+                    conn.execute("DELETE FROM results WHERE key = ?", (old_key,))
+                    conn.execute("DELETE FROM result_outputs WHERE key = ?", (old_key,))
+                    total -= size
+        except Exception as e:
+            print(f"Error writing result store: {e}")
+
+    def get(self, key):
+        """
+        Return the stored result for a key, or None.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][1]
+        result = self._load(key)
+        if result is not None:
+            with self._lock:
+                self._remember(key, result)
+        return result
+
+    def put(self, key, result):
+        """
+        Store a result in memory and, if configured, on disk.
+        """
+        if result.get("incomplete"):
+            return
+        with self._lock:
+            self._remember(key, result)
+        self._save(key, result)
+
+    def get_or_compute(self, key, compute, on_wait=None):
+        """
+        Return (result, source) for a key, calling compute() only if no
+        stored or in-flight result exists.
+
+        source is "memory" or "disk" for stored results, "shared" when the
+        caller waited for another thread computing the same key (on_wait,
+        if given, is called before waiting) and "computed" otherwise. If
+        compute() raises, the error is re-raised in every waiting caller
+        and nothing is stored; an incomplete result is likewise shared
+        with waiting callers but not stored.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][1], "memory"
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+
+        if not owner:
+            if on_wait:
+                on_wait()
+            return future.result(), "shared"
+
+        try:
+            result = self._load(key)
+            if result is not None:
+                source = "disk"
+                with self._lock:
+                    self._remember(key, result)
+            else:
+                source = "computed"
+                result = compute()
+                self.put(key, result)
+            future.set_result(result)
+            return result, source
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def stats(self):
+        """
+        Return the number of results and bytes held in memory, and the number in flight.
+        """
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "inflight": len(self._inflight)}
+
+    def clear(self):
+        """
+        Drop all results held in memory (the on-disk tier is kept).
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules live at the repository root and the benchmark helpers (e.g. the
+# fake OpenAI server) in benchmarks/, neither of which is an installed package
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "benchmarks")]
@@ -0,0 +1,114 @@
+"""
+Tests for repairing and parsing the model's analysis JSON.
+"""
+import json
+
+from sop_pipeline import StepStreamParser, parse_analysis_response, repair_json
+
+ANALYSIS = {
+    "title": "Order handling",
+    "Objective": "Ship orders",
+    "purpose": "Describe the order process",
+    "steps": [
+        {"step": "1", "role": "Sales", "activities": [{"task": "Create Sales Order", "details": ["Check credit"]}]},
+        {"step": "2", "role": "Warehouse", "activities": [{"task": "Pick goods", "details": ["Use the {bin} list"]}]},
+    ],
+}
+
+
+def test_repair_json_valid_object():
+    assert repair_json(json.dumps(ANALYSIS)) == ANALYSIS
+
+
+def test_repair_json_trailing_commas():
+    assert repair_json('{"a": [1, 2,], "b": {"c": 3,},}') == {"a": [1, 2], "b": {"c": 3}}
+
+
+def test_repair_json_ignores_text_around_the_object():
+    assert repair_json('Here you go: {"a": 1} Hope this helps! {"b": 2}') == {"a": 1}
+
+
+def test_repair_json_skips_braces_in_leading_prose():
+    text = 'Note {see below}. ' + json.dumps(ANALYSIS)
+    assert repair_json(text) == ANALYSIS
+
+
+def test_repair_json_skips_objects_without_required_key():
+    text = 'Legend: {"box": "task"} ' + json.dumps(ANALYSIS)
+    assert repair_json(text) == {"box": "task"}
+    assert repair_json(text, "steps") == ANALYSIS
+
+
+def test_repair_json_closes_truncated_string_and_containers():
+    text = json.dumps(ANALYSIS)[:-40]
+    repaired = repair_json(text)
+    assert repaired["title"] == ANALYSIS["title"]
+    assert repaired["steps"][0] == ANALYSIS["steps"][0]
+
+
+def test_repair_json_drops_incomplete_element():
+    assert repair_json('{"a": 1, "b": tr') == {"a": 1}
+
+
+def test_repair_json_braces_inside_strings():
+    assert repair_json('{"a": "}{", "b": "\\"}"}') == {"a": "}{", "b": '"}'}
+
+
+def test_repair_json_without_object():
+    assert repair_json("I cannot analyze this image.") is None
+    assert repair_json("[1, 2, 3]") is None
+
+
+def test_parse_analysis_response_rejects_non_analyses():
+    assert parse_analysis_response("{ I cannot analyze this image") is None
+    assert parse_analysis_response('{"title": "x", "Objective": "y"') is None
+    assert parse_analysis_response('{"title": "x", "steps": "none"}') is None
+
+
+def test_parse_analysis_response_from_code_block():
+    text = "Here is the analysis:\n```json\n" + json.dumps(ANALYSIS) + "\n```\n"
+    assert parse_analysis_response(text) == ANALYSIS
+
+
+def test_parse_analysis_response_from_prose_with_braces():
+    text = "Note {see below}.\n" + json.dumps(ANALYSIS) + "\nLet me know {if} anything is missing."
+    assert parse_analysis_response(text) == ANALYSIS
+
+
+def test_parse_analysis_response_batched_envelope():
+    text = json.dumps({"diagrams": [ANALYSIS, ANALYSIS]})
+    assert parse_analysis_response(text, "diagrams") == {"diagrams": [ANALYSIS, ANALYSIS]}
+    assert parse_analysis_response(text) is None
+
+
+def test_step_stream_parser_yields_each_step_once_complete():
+    text = json.dumps(ANALYSIS)
+    parser = StepStreamParser()
+    steps = []
+    completed_at = []
+    for position in range(0, len(text), 7):
+        new_steps = parser.feed(text[position:position + 7])
+        steps.extend(new_steps)
+        completed_at.extend([position] * len(new_steps))
+    assert steps == ANALYSIS["steps"]
+    # The first step is returned before the stream ends
+    assert completed_at[0] < len(text) - len(json.dumps(ANALYSIS["steps"][1]))
+
+
+def test_step_stream_parser_single_characters():
+    parser = StepStreamParser()
+    steps = [step for ch in json.dumps(ANALYSIS, indent=2) for step in parser.feed(ch)]
+    assert steps == ANALYSIS["steps"]
+
+
+def test_step_stream_parser_ignores_nested_steps_keys():
+    analysis = {"title": "t", "notes": {"steps": [{"step": "x"}]}, "steps": [{"step": "1"}]}
+    parser = StepStreamParser()
+    assert parser.feed(json.dumps(analysis)) == [{"step": "1"}]
+
+
+def test_step_stream_parser_incomplete_stream():
+    parser = StepStreamParser()
+    text = json.dumps(ANALYSIS)
+    cut = text.index('{"step": "2"') + 20
+    assert parser.feed(text[:cut]) == [ANALYSIS["steps"][0]]
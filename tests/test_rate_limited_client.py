@@ -0,0 +1,127 @@
+"""
+Tests for the rate-limited OpenAI client: budgets, retries and Retry-After.
+"""
+import types
+
+import pytest
+
+from sop_pipeline import RateLimitedClient
+
+
+def error_with_headers(headers):
+    return types.SimpleNamespace(response=types.SimpleNamespace(headers=headers))
+
+
+def test_budget_wait_allows_requests_within_budget():
+    client = RateLimitedClient(None, requests_per_minute=2, tokens_per_minute=1000)
+    client._window.extend([[100.0, 100]])
+    assert client._budget_wait(110.0, 100) == 0
+
+
+def test_budget_wait_request_limit_waits_for_oldest_request():
+    client = RateLimitedClient(None, requests_per_minute=2, tokens_per_minute=0)
+    client._window.extend([[100.0, 10], [130.0, 10]])
+    assert client._budget_wait(140.0, 10) == pytest.approx(20.0)
+
+
+def test_budget_wait_token_limit_waits_until_enough_tokens_expire():
+    client = RateLimitedClient(None, requests_per_minute=0, tokens_per_minute=1000)
+    client._window.extend([[100.0, 400], [110.0, 400], [120.0, 100]])
+    # 900 tokens in the window: 500 more fit once the first request expires,
+    # 600 more once the first two have
+    assert client._budget_wait(130.0, 500) == pytest.approx(30.0)
+    assert client._budget_wait(130.0, 600) == pytest.approx(40.0)
+
+
+def test_budget_wait_drops_requests_older_than_a_minute():
+    client = RateLimitedClient(None, requests_per_minute=1, tokens_per_minute=0)
+    client._window.extend([[100.0, 10]])
+    assert client._budget_wait(160.0, 10) == 0
+    assert not client._window
+
+
+def test_budget_wait_oversized_request_runs_on_empty_window():
+    client = RateLimitedClient(None, requests_per_minute=0, tokens_per_minute=1000)
+    assert client._budget_wait(100.0, 5000) == 0
+
+
+def test_retry_delay_honours_retry_after_headers():
+    client = RateLimitedClient(None, backoff_base=1.0, backoff_max=30.0)
+    assert client._retry_delay(error_with_headers({"retry-after-ms": "250"}), 0) == pytest.approx(0.25)
+    assert client._retry_delay(error_with_headers({"retry-after": "3"}), 0) == pytest.approx(3.0)
+
+
+def test_retry_delay_falls_back_to_bounded_backoff():
+    client = RateLimitedClient(None, backoff_base=1.0, backoff_max=5.0)
+    for attempt in range(8):
+        assert 0 <= client._retry_delay(error_with_headers({"retry-after": "soon"}), attempt) <= 5.0
+    assert 0 <= client._retry_delay(Exception("no response"), 1) <= 2.0
+
+
+@pytest.fixture
+def fake_server():
+    from fake_openai_server import start_server
+    servers = []
+
+    def start(**settings):
+        server = start_server(latency=0.0, **settings)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def make_client(server, **settings):
+    openai = pytest.importorskip("openai")
+    return RateLimitedClient(
+        openai.OpenAI(api_key="stub", base_url=server.base_url, max_retries=0),
+        backoff_base=0.01, backoff_max=0.05, **settings
+    )
+
+
+def test_retries_until_success(fake_server):
+    server = fake_server(failure_rate=0.5, seed=3)
+    client = make_client(server, max_retries=10)
+    for _ in range(5):
+        response = client.create_chat_completion(model="stub", messages=[{"role": "user", "content": "hi"}])
+        assert response.choices[0].message.content
+    counters = client.counters()
+    assert counters["requests"] == server.counters["requests"]
+    assert counters["retries"] == server.counters["failures"] > 0
+    assert counters["prompt_tokens"] > 0
+
+
+def test_gives_up_after_max_retries(fake_server):
+    openai = pytest.importorskip("openai")
+    server = fake_server(failure_rate=1.0)
+    client = make_client(server, max_retries=2)
+    with pytest.raises(openai.APIStatusError):
+        client.create_chat_completion(model="stub", messages=[{"role": "user", "content": "hi"}])
+    assert server.counters["requests"] == 3
+    assert client.counters()["failures"] == 1
+
+
+def test_rate_limit_retry_waits_for_retry_after(fake_server, monkeypatch):
+    openai = pytest.importorskip("openai")
+    server = fake_server(failure_rate=1.0)
+    client = make_client(server, max_retries=1)
+    # Only 429s, which the stub answers with retry-after-ms: 100
+    monkeypatch.setattr(server.random, "choice", lambda options: 429)
+    with pytest.raises(openai.RateLimitError):
+        client.create_chat_completion(model="stub", messages=[{"role": "user", "content": "hi"}])
+    counters = client.counters()
+    assert counters["retries"] == 1
+    assert counters["backoff_seconds"] == pytest.approx(0.1)
+    assert counters["rate_limited"] == 2
+
+
+def test_stream_yields_content_and_records_usage(fake_server):
+    server = fake_server(step_count=2)
+    client = make_client(server)
+    text = "".join(client.stream_chat_completion(model="stub", messages=[{"role": "user", "content": "hi"}]))
+    assert '"steps"' in text
+    assert server.counters["streamed"] == 1
+    assert client.counters()["completion_tokens"] > 0
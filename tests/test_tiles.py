@@ -0,0 +1,93 @@
+"""
+Tests for splitting oversized diagrams into tiles and merging their analyses.
+"""
+import pytest
+
+from sop_pipeline import merge_tile_analyses, tile_boxes
+
+
+def step(number, role, *tasks, details=()):
+    return {
+        "step": str(number),
+        "role": role,
+        "activities": [{"task": task, "details": list(details)} for task in tasks],
+    }
+
+
+def test_small_image_is_one_tile():
+    assert tile_boxes(1000, 800, tile_size=2048) == [(0, 0, 1000, 800)]
+
+
+@pytest.mark.parametrize("width, height", [(5000, 3000), (4096, 2048), (2049, 9000), (12000, 2100)])
+def test_tiles_cover_the_image_with_overlap(width, height):
+    tile_size, overlap = 2048, 0.15
+    boxes = tile_boxes(width, height, tile_size=tile_size, overlap=overlap)
+    for left, top, right, bottom in boxes:
+        assert 0 <= left < right <= width and 0 <= top < bottom <= height
+        assert right - left == min(tile_size, width) and bottom - top == min(tile_size, height)
+    for axis, length in ((0, width), (1, height)):
+        starts = sorted({box[axis] for box in boxes})
+        ends = sorted({box[axis + 2] for box in boxes})
+        assert starts[0] == 0 and ends[-1] == length
+        # Neighbouring tiles overlap by at least the requested fraction
+        for end, next_start in zip(ends, starts[1:]):
+            assert end - next_start >= overlap * tile_size - 1
+
+
+def test_tiles_are_listed_row_by_row():
+    boxes = tile_boxes(5000, 3000, tile_size=2048, overlap=0.15)
+    assert [box[1] for box in boxes] == sorted(box[1] for box in boxes)
+    columns = len({box[0] for box in boxes})
+    assert boxes[:columns] == sorted(boxes[:columns])
+
+
+def test_merge_keeps_overview_fields_and_order():
+    overview = {"title": "T", "Objective": "O", "purpose": "P",
+                "steps": [step(1, "Clerk", "Receive order"), step(2, "Manager", "Approve order")]}
+    merged = merge_tile_analyses(overview, [{"title": "Tile", "steps": [step(1, "Manager", "Approve order")]}])
+    assert (merged["title"], merged["Objective"], merged["purpose"]) == ("T", "O", "P")
+    assert [s["activities"][0]["task"] for s in merged["steps"]] == ["Receive order", "Approve order"]
+
+
+def test_merge_combines_a_box_seen_in_overlapping_tiles():
+    overview = {"steps": [step(1, "Clerk", "Receive order", details=["a"])]}
+    tiles = [
+        {"steps": [step(1, "Clerk", "Receive order", details=["a", "check id"])]},
+        {"steps": [step(1, "clerk ", "receive  Order", details=["stamp"])]},
+    ]
+    merged = merge_tile_analyses(overview, tiles)
+    assert len(merged["steps"]) == 1
+    assert merged["steps"][0]["activities"][0]["details"] == ["a", "check id", "stamp"]
+
+
+def test_merge_keeps_distinct_boxes_of_one_lane_apart():
+    overview = {"steps": [step(1, "Sales", "Create Sales Order")]}
+    merged = merge_tile_analyses(overview, [{"steps": [step(1, "Sales", "Create Sales Quotation")]}])
+    assert [s["activities"][0]["task"] for s in merged["steps"]] == ["Create Sales Order", "Create Sales Quotation"]
+
+
+def test_merge_requires_the_same_role():
+    overview = {"steps": [step(1, "Clerk", "Review order")]}
+    merged = merge_tile_analyses(overview, [{"steps": [step(1, "Manager", "Review order")]}])
+    assert [s["role"] for s in merged["steps"]] == ["Clerk", "Manager"]
+
+
+def test_merge_keeps_repeated_boxes_of_one_analysis():
+    tile = {"steps": [step(1, "Clerk", "Check form"), step(2, "Clerk", "Check form")]}
+    merged = merge_tile_analyses(None, [tile, {"steps": [step(1, "Clerk", "Check form")]}])
+    assert len(merged["steps"]) == 2
+
+
+def test_merge_inserts_new_steps_after_the_last_match():
+    overview = {"steps": [step(1, "A", "First"), step(2, "C", "Last")]}
+    tile = {"steps": [step(1, "A", "First"), step(2, "B", "Middle")]}
+    merged = merge_tile_analyses(overview, [tile])
+    assert [s["role"] for s in merged["steps"]] == ["A", "B", "C"]
+    # Labels repeated across sources are renumbered
+    assert [s["step"] for s in merged["steps"]] == ["1", "2", "3"]
+
+
+def test_merge_skips_missing_analyses():
+    assert merge_tile_analyses(None, [None, None]) is None
+    merged = merge_tile_analyses(None, [None, {"title": "T", "steps": [step(1, "A", "Only")]}])
+    assert merged["title"] == "T" and len(merged["steps"]) == 1
@@ -0,0 +1,78 @@
+"""
+Tests for reading PDFs from ZIP archives within the ZIP_MAX_* limits.
+"""
+import io
+import zipfile
+
+import pytest
+
+import sop_pipeline
+from sop_pipeline import iter_zip_members, iter_zip_pdfs
+
+
+def make_zip(members, compression=zipfile.ZIP_DEFLATED):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression) as zip_file:
+        for name, data in members.items():
+            zip_file.writestr(name, data)
+    return buffer.getvalue()
+
+
+def test_members_are_pdfs_in_name_order():
+    data = make_zip({"b.pdf": b"%PDF-b", "a/c.PDF": b"%PDF-c", "notes.txt": b"x", "a/": b""})
+    assert [(name, stream.read()) for name, stream in iter_zip_members(data)] == [
+        ("c.PDF", b"%PDF-c"), ("b.pdf", b"%PDF-b")
+    ]
+
+
+def test_full_paths_keep_members_in_folders_apart():
+    data = make_zip({"x/report.pdf": b"%PDF-x", "y/report.pdf": b"%PDF-y"})
+    assert [name for name, _ in iter_zip_pdfs(data)] == ["report.pdf", "report.pdf"]
+    assert [name for name, _ in iter_zip_pdfs(data, full_paths=True)] == ["x/report.pdf", "y/report.pdf"]
+
+
+def test_spooled_members_are_written_to_files(tmp_path):
+    data = make_zip({"a.pdf": b"%PDF-a", "b.pdf": b"%PDF-b"})
+    pdfs = list(iter_zip_pdfs(data, spool_dir=str(tmp_path)))
+    assert [open(path, "rb").read() for _, path in pdfs] == [b"%PDF-a", b"%PDF-b"]
+
+
+def test_too_many_members(monkeypatch):
+    monkeypatch.setattr(sop_pipeline, "ZIP_MAX_MEMBERS", 2)
+    data = make_zip({f"{index}.pdf": b"%PDF" for index in range(3)})
+    with pytest.raises(ValueError, match="more than the limit of 2"):
+        next(iter_zip_members(data))
+
+
+def test_member_too_large(monkeypatch):
+    monkeypatch.setattr(sop_pipeline, "ZIP_MAX_MEMBER_BYTES", 100)
+    data = make_zip({"big.pdf": b"%PDF" + bytes(200)}, zipfile.ZIP_STORED)
+    with pytest.raises(ValueError, match="big.pdf is 204 bytes uncompressed"):
+        next(iter_zip_members(data))
+
+
+def test_total_size_too_large(monkeypatch):
+    monkeypatch.setattr(sop_pipeline, "ZIP_MAX_TOTAL_BYTES", 300)
+    data = make_zip({f"{index}.pdf": bytes(200) for index in range(2)}, zipfile.ZIP_STORED)
+    with pytest.raises(ValueError, match="expands to 400 bytes"):
+        next(iter_zip_members(data))
+
+
+def test_suspected_zip_bomb():
+    data = make_zip({"bomb.pdf": bytes(4 * 1024 * 1024)})
+    with pytest.raises(ValueError, match="suspected zip bomb"):
+        next(iter_zip_members(data))
+
+
+def test_small_compressible_members_are_allowed():
+    # The compression ratio is only checked for members over 1 MB
+    data = make_zip({"small.pdf": bytes(512 * 1024)})
+    assert [name for name, _ in iter_zip_members(data)] == ["small.pdf"]
+
+
+def test_limits_are_checked_before_any_member_is_yielded(monkeypatch):
+    monkeypatch.setattr(sop_pipeline, "ZIP_MAX_MEMBER_BYTES", 100)
+    data = make_zip({"a.pdf": b"%PDF", "z.pdf": bytes(200)}, zipfile.ZIP_STORED)
+    members = iter_zip_members(data)
+    with pytest.raises(ValueError):
+        next(members)